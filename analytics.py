@@ -0,0 +1,375 @@
+import os
+import sys
+import json
+import glob
+import time
+import hashlib
+import argparse
+import numpy as np
+from transcript import transcript_files, open_transcript
+
+# 將 transcript.py 寫出的逐回合紀錄轉成欄位式的 NumPy 陣列（每次只轉換新增的部分），
+# 再以向量化運算計算階段漏斗、依角色屬性的分組統計、各階段延遲與 token 百分位數。
+
+PHASES = ("detail", "inner_activity", "reply", "judge", "total")
+MANIFEST = "manifest.json"
+
+# 欄位名稱與型別；缺值以 -1（整數）或 NaN（浮點數）表示
+COLUMNS = {
+    "session": np.int64,
+    "persona": np.int32,
+    "turn": np.int32,
+    "stage": np.int16,
+    "is_pass": np.bool_,
+    "timed_out": np.bool_,
+    "reference": np.int8,  # 人工標註的參考判定：1 通過、0 未通過、-1 無標註
+    "ts": np.float64,
+    "input_tokens": np.int32,
+    "output_tokens": np.int32,
+    **{f"t_{name}": np.float32 for name in PHASES},
+}
+
+
+def session_key(session_id) -> int:
+    """
+    將 session id 雜湊成 int64，讓跨檔案的分組可以直接用整數陣列運算。
+    """
+    digest = hashlib.blake2b(str(session_id).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def record_key(record: dict) -> str:
+    return f"{record.get('ts')}|{record.get('session_id')}|{record.get('type')}"
+
+
+def _int(value, default=-1) -> int:
+    return default if value is None else int(value)
+
+
+class ColumnBuilder:
+    """
+    逐筆累積 turn 紀錄的欄位值，最後一次轉成 NumPy 陣列。
+    """
+    def __init__(self):
+        self.values = {name: [] for name in COLUMNS}
+
+    def __len__(self):
+        return len(self.values["session"])
+
+    def append(self, record: dict):
+        if record.get("type") != "turn":
+            return
+        values = self.values
+        values["session"].append(session_key(record.get("session_id")))
+        values["persona"].append(_int(record.get("persona_id")))
+        values["turn"].append(_int(record.get("turn")))
+        values["stage"].append(_int(record.get("stage")))
+        values["is_pass"].append(bool(record.get("is_pass")))
+        values["timed_out"].append(bool(record.get("verdict_timed_out")))
+        reference = record.get("reference_is_pass")
+        values["reference"].append(-1 if reference is None else int(bool(reference)))
+        values["ts"].append(record.get("ts") or np.nan)
+        values["input_tokens"].append(_int(record.get("input_tokens")))
+        values["output_tokens"].append(_int(record.get("output_tokens")))
+        timings = record.get("timings_ms") or {}
+        for name in PHASES:
+            values[f"t_{name}"].append(timings.get(name, np.nan))
+
+    def to_arrays(self) -> dict:
+        return {name: np.asarray(self.values[name], dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+class TranscriptStore:
+    """
+    以目錄保存轉換後的欄位資料：每次 update() 產生一個 chunk-*.npz，manifest.json 記錄處理進度。
+
+    - 輪替後的檔案不會再變動，處理過一次就記錄在 done 中。
+    - 目前的檔案記錄讀到的位元組位置與第一筆紀錄；檔案被輪替後，
+      對應的輪替檔開頭已讀過的紀錄會被略過，不會重複計算。
+    """
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.manifest_path = os.path.join(store_dir, MANIFEST)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"done": [], "live": {}, "next_chunk": 0}
+
+    def _read_rotated(self, file_path: str, live_state: dict, builder: ColumnBuilder) -> bool:
+        """
+        讀取一個輪替檔；若它就是先前讀到一半的目前檔案，略過已讀的紀錄。回傳是否對應到 live_state。
+        """
+        skip = 0
+        matched = False
+        count = 0
+        with open_transcript(file_path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    record = None
+                if count == 0 and live_state and record is not None and record_key(record) == live_state["first"]:
+                    skip = live_state["records"]
+                    matched = True
+                count += 1
+                if count <= skip or record is None:
+                    continue
+                builder.append(record)
+        return matched
+
+    def _read_live(self, path: str, state: dict, builder: ColumnBuilder) -> dict:
+        """
+        從上次的位置讀取目前檔案中完整的新行，回傳更新後的進度。
+        """
+        with open(path, "rb") as f:
+            first_line = f.readline()
+            if not first_line.endswith(b"\n"):
+                return state  # 第一行還沒寫完
+            try:
+                first = record_key(json.loads(first_line))
+            except json.JSONDecodeError:
+                first = None
+            if state is None or state["first"] != first:
+                state = {"first": first, "offset": 0, "records": 0}
+            f.seek(state["offset"])
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            state["records"] += 1
+            try:
+                builder.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        state["offset"] += end
+        return state
+
+    def update(self, paths: list) -> int:
+        """
+        轉換 paths（transcript 主檔路徑，會一併找出其輪替檔）中尚未處理的紀錄，回傳新增的回合數。
+        """
+        builder = ColumnBuilder()
+        done = set(self.manifest["done"])
+        live = self.manifest["live"]
+        for path in paths:
+            for file_path in transcript_files(path):
+                if file_path == path:
+                    live[path] = self._read_live(path, live.get(path), builder)
+                elif file_path not in done:
+                    if self._read_rotated(file_path, live.get(path), builder):
+                        live.pop(path, None)
+                    done.add(file_path)
+        rows = len(builder)
+        os.makedirs(self.store_dir, exist_ok=True)
+        if rows:
+            chunk = os.path.join(self.store_dir, f"chunk-{self.manifest['next_chunk']:06d}.npz")
+            np.savez(chunk, **builder.to_arrays())
+            self.manifest["next_chunk"] += 1
+        self.manifest["done"] = sorted(done)
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        return rows
+
+    def load(self) -> dict:
+        """
+        讀取全部 chunk，合併成每個欄位一個陣列。
+        """
+        chunks = sorted(glob.glob(os.path.join(self.store_dir, "chunk-*.npz")))
+        if not chunks:
+            return {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        loaded = [np.load(chunk) for chunk in chunks]
+        return {name: np.concatenate([data[name] for data in loaded]) for name in COLUMNS}
+
+
+def _percentiles(values: np.ndarray, qs=(50, 90, 99)) -> dict:
+    values = values[~np.isnan(values)] if values.dtype.kind == "f" else values
+    if values.size == 0:
+        return {"count": 0}
+    result = {"count": int(values.size), "mean": round(float(values.mean()), 3)}
+    for q, value in zip(qs, np.percentile(values, qs)):
+        result[f"p{q}"] = round(float(value), 3)
+    return result
+
+
+def stage_funnel(cols: dict, n_stages: int) -> list:
+    """
+    每個會話到達的最高階段（通過的回合會進入下一階段），統計到達各階段的會話數。
+    第 n_stages + 1 階段代表完成全部階段。
+    """
+    sessions, inverse = np.unique(cols["session"], return_inverse=True)
+    reached = np.zeros(len(sessions), dtype=np.int32)
+    np.maximum.at(reached, inverse, cols["stage"].astype(np.int32) + cols["is_pass"])
+    funnel = []
+    previous = len(sessions)
+    for stage in range(1, n_stages + 2):
+        count = int((reached >= stage).sum())
+        funnel.append({
+            "stage": stage if stage <= n_stages else "completed",
+            "sessions": count,
+            "conversion": round(count / previous, 4) if previous else None,
+        })
+        previous = count
+    return funnel
+
+
+def stage_groups(cols: dict) -> dict:
+    """
+    以（會話, 階段）分組：每組的回合數、是否通過與角色編號。
+    """
+    _, session_index = np.unique(cols["session"], return_inverse=True)
+    keys = session_index.astype(np.int64) * 1024 + cols["stage"]
+    groups, inverse, turns = np.unique(keys, return_inverse=True, return_counts=True)
+    passed = np.bincount(inverse, weights=cols["is_pass"], minlength=len(groups)) > 0
+    persona = np.full(len(groups), -1, dtype=np.int32)
+    persona[inverse] = cols["persona"]
+    return {"stage": (groups % 1024).astype(np.int16), "turns": turns, "passed": passed, "persona": persona}
+
+
+def persona_labels(personas: list, attribute: str, bin_width: int = None) -> dict:
+    """
+    依角色屬性（可用「家庭結構.家庭人數」指定巢狀欄位）分組，回傳 {標籤: 角色編號陣列}。
+    列表屬性（如保險興趣）的角色會出現在每個對應的組別；數值屬性可用 bin_width 分段。
+    """
+    labels = {}
+    for persona in personas:
+        value = persona
+        for part in attribute.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        values = value if isinstance(value, list) else [value]
+        for item in values:
+            if bin_width and isinstance(item, (int, float)) and not isinstance(item, bool):
+                low = int(item // bin_width * bin_width)
+                item = f"{low}-{low + bin_width - 1}"
+            labels.setdefault(str(item), []).append(persona.get("客戶編號", -1))
+    return {label: np.asarray(ids, dtype=np.int32) for label, ids in sorted(labels.items())}
+
+
+def turns_to_pass(groups: dict, mask: np.ndarray, n_stages: int) -> dict:
+    """
+    mask 範圍內，各階段（s→s+1）通過所需的回合數。
+    """
+    result = {}
+    for stage in range(1, n_stages + 1):
+        selected = mask & groups["passed"] & (groups["stage"] == stage)
+        target = stage + 1 if stage < n_stages else "completed"
+        result[f"{stage}->{target}"] = _percentiles(groups["turns"][selected].astype(np.float64), (50, 90))
+    return result
+
+
+def breakdown(groups: dict, personas: list, attribute: str, n_stages: int, bin_width: int = None) -> dict:
+    return {
+        label: turns_to_pass(groups, np.isin(groups["persona"], ids), n_stages)
+        for label, ids in persona_labels(personas, attribute, bin_width).items()
+    }
+
+
+def latency_summary(cols: dict) -> dict:
+    """
+    各階段延遲（毫秒）的百分位數，以及各階段佔整回合時間的比例。
+    """
+    result = {name: _percentiles(cols[f"t_{name}"]) for name in PHASES}
+    total = np.nansum(cols["t_total"])
+    if total:
+        result["share_of_total"] = {
+            name: round(float(np.nansum(cols[f"t_{name}"]) / total), 4) for name in PHASES if name != "total"
+        }
+    return result
+
+
+def judge_summary(cols: dict, n_stages: int) -> dict:
+    """
+    裁判的通過率與逾時數；有參考判定的回合另外計算各階段的誤判（false positive / false negative）。
+    """
+    result = {
+        "turns": int(cols["is_pass"].size),
+        "pass_rate": round(float(cols["is_pass"].mean()), 4) if cols["is_pass"].size else None,
+        "timed_out": int(cols["timed_out"].sum()),
+    }
+    labelled = cols["reference"] >= 0
+    if not labelled.any():
+        return result
+    false_positive = labelled & cols["is_pass"] & (cols["reference"] == 0)
+    false_negative = labelled & ~cols["is_pass"] & (cols["reference"] == 1)
+    negatives = labelled & (cols["reference"] == 0)
+    by_stage = {}
+    for stage in range(1, n_stages + 1):
+        in_stage = cols["stage"] == stage
+        stage_negatives = int((negatives & in_stage).sum())
+        by_stage[stage] = {
+            "labelled": int((labelled & in_stage).sum()),
+            "false_positives": int((false_positive & in_stage).sum()),
+            "false_negatives": int((false_negative & in_stage).sum()),
+            "false_positive_rate": round(int((false_positive & in_stage).sum()) / stage_negatives, 4) if stage_negatives else None,
+        }
+    result.update({
+        "labelled": int(labelled.sum()),
+        "false_positives": int(false_positive.sum()),
+        "false_negatives": int(false_negative.sum()),
+        "by_stage": by_stage,
+    })
+    return result
+
+
+def summarize(cols: dict, personas: list, n_stages: int, attributes: list, bin_width: int = None) -> dict:
+    groups = stage_groups(cols)
+    everyone = np.ones(len(groups["stage"]), dtype=bool)
+    return {
+        "turns": int(cols["session"].size),
+        "sessions": int(np.unique(cols["session"]).size),
+        "funnel": stage_funnel(cols, n_stages),
+        "turns_to_pass": turns_to_pass(groups, everyone, n_stages),
+        "by_attribute": {
+            attribute: breakdown(groups, personas, attribute, n_stages, bin_width) for attribute in attributes
+        },
+        "latency_ms": latency_summary(cols),
+        "tokens": {
+            "input": _percentiles(cols["input_tokens"][cols["input_tokens"] >= 0].astype(np.float64)),
+            "output": _percentiles(cols["output_tokens"][cols["output_tokens"] >= 0].astype(np.float64)),
+        },
+        "judge": judge_summary(cols, n_stages),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="對話紀錄分析：階段漏斗、依角色屬性分組、延遲與 token 百分位數")
+    parser.add_argument("--transcript", action="append", default=[],
+                        help="transcript 主檔路徑（可重複指定，預設 transcripts/transcript.jsonl）")
+    parser.add_argument("--store", default="analytics_store", help="欄位資料的保存目錄")
+    parser.add_argument("--no-update", action="store_true", help="只分析已轉換的資料，不讀取新紀錄")
+    parser.add_argument("--personas", default="persona.json")
+    parser.add_argument("--stage-info", default="stage_info.json")
+    parser.add_argument("--by", action="append", default=[], help="分組的角色屬性，例如 MBTI、年齡、家庭結構.家庭人數")
+    parser.add_argument("--bin", type=int, default=None, help="數值屬性的分段寬度，例如年齡以 10 歲為一組")
+    parser.add_argument("--output", default=None, help="將報告輸出為 JSON 檔")
+    args = parser.parse_args()
+
+    store = TranscriptStore(args.store)
+    started = time.monotonic()
+    if not args.no_update:
+        added = store.update(args.transcript or ["transcripts/transcript.jsonl"])
+        print(f"新增 {added} 個回合（{time.monotonic() - started:.2f} 秒）", file=sys.stderr)
+    started = time.monotonic()
+    cols = store.load()
+    with open(args.personas, encoding="utf-8") as f:
+        personas = json.load(f)
+    with open(args.stage_info, encoding="utf-8") as f:
+        n_stages = len(json.load(f))
+    report = summarize(cols, personas, n_stages, args.by, args.bin)
+    print(f"分析 {report['turns']} 個回合（{time.monotonic() - started:.2f} 秒）", file=sys.stderr)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import gc
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+
+# 量測閒置會話的記憶體用量：以 server.py 的 /start 與回合流程建立 N 個會話（使用零延遲 MockLLM），
+# 比較建立前後的 RSS。每種規模在獨立的子行程中執行，避免彼此的記憶體互相影響。
+
+SIZES = (1000, 10000, 100000)
+MODES = ("hot", "compacted")
+
+
+async def build_sessions(count: int, turns: int, compact: bool):
+    """
+    compact=True 時每個會話建立後立即壓縮，相當於閒置壓縮已處理過所有會話；
+    釋放的記憶體會被之後建立的會話重複利用，RSS 才反映壓縮後的大小。
+    """
+    import server
+
+    request = server.StartSessionRequest(llm_choice="mock")
+    for i in range(count):
+        started = await server.start_session(request)
+        session = server.sessions[started.session_id]
+        for turn in range(turns):
+            await server.run_turn(session, f"你好，我是業務員，第 {turn} 次想跟您聊聊保障規劃。", session_id=started.session_id)
+        if compact:
+            session.compact()
+
+
+async def measure(count: int, turns: int, mode: str) -> dict:
+    from diagnostics import rss_bytes
+
+    # 先建立一個會話再量測基準，排除模組載入與共用資料（角色目錄、LLM 實例）的一次性成本
+    await build_sessions(1, turns, mode == "compacted")
+    gc.collect()
+    before = rss_bytes()
+    started = time.monotonic()
+    await build_sessions(count, turns, mode == "compacted")
+    build_seconds = time.monotonic() - started
+    gc.collect()
+    after = rss_bytes()
+    return {
+        "sessions": count,
+        "mode": mode,
+        "turns": turns,
+        "rss_growth_bytes": after - before,
+        "bytes_per_session": round((after - before) / count),
+        "build_seconds": round(build_seconds, 2),
+    }
+
+
+def child(count: int, turns: int, mode: str, response_chars: int) -> dict:
+    # 不寫對話紀錄，只保留會話本身；角色細節與回應的長度由 MockLLM 的 response_chars 決定；/start 預設不允許 mock
+    os.environ["TRANSCRIPT_PATH"] = ""
+    os.environ["ALLOWED_LLM_CHOICES"] = "mock"
+    os.environ["MOCK_LLM_RESPONSE_CHARS"] = str(response_chars)
+    return asyncio.run(measure(count, turns, mode))
+
+
+def run_child(count: int, turns: int, mode: str, response_chars: int) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", str(count), "--turns", str(turns), "--mode", mode,
+         "--response-chars", str(response_chars)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="量測每個閒置會話佔用的記憶體（使用零延遲 MockLLM）")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in SIZES), help="會話數，以逗號分隔")
+    parser.add_argument("--modes", default=",".join(MODES), help="hot：未壓縮；compacted：所有會話都已閒置壓縮")
+    parser.add_argument("--turns", type=int, default=3, help="每個會話先進行的回合數")
+    parser.add_argument("--response-chars", type=int, default=400, help="MockLLM 每次回應（含角色細節）的最大字數")
+    parser.add_argument("--output", default=None, help="結果 JSON 檔（預設輸出到標準輸出）")
+    parser.add_argument("--child", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--mode", default="hot", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(child(args.child, args.turns, args.mode, args.response_chars)))
+        return
+
+    results = []
+    for size in (int(value) for value in args.sizes.split(",")):
+        for mode in args.modes.split(","):
+            print(f"{size} 個會話（{mode}）...", file=sys.stderr)
+            result = run_child(size, args.turns, mode, args.response_chars)
+            print(f"  每個會話 {result['bytes_per_session']} bytes，建立耗時 {result['build_seconds']} 秒", file=sys.stderr)
+            results.append(result)
+
+    output = json.dumps({"results": results}, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+from character import Character, load_stage_info
+from judge import Judge
+from llm.mock import MockLLM
+
+# 量測每回合中「我們自己的程式」所花的時間：LLM 一律使用零延遲的 MockLLM。
+
+HISTORY_LENGTHS = (1, 10, 100, 1000)
+
+# 重複使用同一個事件迴圈，避免把 asyncio.run 建立迴圈的成本算進去
+_loop = asyncio.new_event_loop()
+
+def run(coro):
+    return _loop.run_until_complete(coro)
+
+
+def measure(func, min_time: float = 0.2, repeat: int = 5) -> dict:
+    """
+    自動決定每輪呼叫次數（至少執行 min_time 秒），重複 repeat 輪，回傳每次呼叫的微秒數。
+    """
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or loops >= 1_000_000:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        samples.append((time.perf_counter() - started) / loops * 1e6)
+    return {
+        "median_us": round(statistics.median(samples), 3),
+        "min_us": round(min(samples), 3),
+        "loops": loops,
+    }
+
+
+def make_character(stage_info: dict, history_length: int = 0) -> Character:
+    with open("persona.json", encoding="utf-8") as f:
+        persona = json.load(f)[0]
+    character_info = json.dumps(persona, indent=2, ensure_ascii=False)
+    character = Character(character_info, MockLLM(response_chars=1000), stage_info, history_window=3)
+    # 角色細節使用約 1000 字的內容，之後的回合改用一般長度的回應
+    character.llm = MockLLM()
+    for i in range(history_length):
+        character.history.append(
+            f"使用者: 第 {i} 個問題，想了解一下保險的保障內容。",
+            "我有點猶豫，但也想聽聽看對方怎麼說。" * 5,
+            "嗯，我考慮一下，可以再多說一點嗎？" * 3,
+        )
+    return character
+
+
+def bench_character(stage_info: dict, results: dict):
+    results["character_construction"] = measure(lambda: make_character(stage_info))
+
+    for length in HISTORY_LENGTHS:
+        character = make_character(stage_info, length)
+        results[f"format_history[{length}]"] = measure(character.format_history)
+
+        def generate_response():
+            run(character.async_generate_response("使用者: 你好，想請教一下"))
+            character.history.pop()
+
+        results[f"generate_response[{length}]"] = measure(generate_response)
+
+    character = make_character(stage_info, 3)
+    results["history_recent"] = measure(character.history.recent)
+
+
+def bench_judge(stage_info: dict, results: dict):
+    judge = Judge(MockLLM())
+    conversation = "\n".join(["使用者: 你好", "角色: 你好，請問有什麼事？"] * 2)
+    stage_description = f"{stage_info[1]}"
+    results["judge_evaluate"] = measure(
+        lambda: run(judge.async_evaluate_stage(conversation, "我有點好奇。", stage_description))
+    )
+
+
+def bench_server(results: dict):
+    from fastapi.testclient import TestClient
+    # 不寫對話紀錄：避免在專案目錄產生檔案，也不把寫檔的成本算進量測；/start 預設不允許 mock
+    os.environ["TRANSCRIPT_PATH"] = ""
+    os.environ["ALLOWED_LLM_CHOICES"] = "mock"
+    import server
+
+    client = TestClient(server.app)
+    results["json_load_persona_and_stage"] = measure(
+        lambda: (json.load(open("persona.json", encoding="utf-8")), load_stage_info("stage_info.json"))
+    )
+
+    def start():
+        session_id = client.post("/start", json={"llm_choice": "mock"}).json()["session_id"]
+        client.post("/end", json={"session_id": session_id})
+
+    results["http_start"] = measure(start)
+
+    session_id = client.post("/start", json={"llm_choice": "mock"}).json()["session_id"]
+    character = server.sessions[session_id].character
+
+    def chat():
+        client.post("/chat", json={"session_id": session_id, "user_input": "你好，想請教一下"})
+        # 維持固定的歷史長度，讓每次量測的工作量相同
+        character.history.pop()
+
+    results["http_chat"] = measure(chat)
+    client.post("/end", json={"session_id": session_id})
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    找出中位數比基準慢超過 threshold 比例的項目。
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base and result["median_us"] > base["median_us"] * (1 + threshold):
+            regressions.append({
+                "name": name,
+                "baseline_us": base["median_us"],
+                "current_us": result["median_us"],
+                "ratio": round(result["median_us"] / base["median_us"], 3),
+            })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="每回合框架開銷的微基準測試（使用零延遲 MockLLM）")
+    parser.add_argument("--only", default=None, choices=["character", "judge", "server"], help="只執行指定的項目群組")
+    parser.add_argument("--save-baseline", default=None, help="將結果存成基準檔")
+    parser.add_argument("--compare", default=None, help="與基準檔比較並標示退步的項目")
+    parser.add_argument("--threshold", type=float, default=0.2, help="視為退步的比例（預設 20%%）")
+    parser.add_argument("--output", default=None, help="將結果輸出為 JSON 檔")
+    args = parser.parse_args()
+
+    stage_info = load_stage_info("stage_info.json")
+    results = {}
+    if args.only in (None, "character"):
+        bench_character(stage_info, results)
+    if args.only in (None, "judge"):
+        bench_judge(stage_info, results)
+    if args.only in (None, "server"):
+        bench_server(results)
+
+    width = max(len(name) for name in results)
+    for name, result in results.items():
+        print(f"{name:<{width}}  {result['median_us']:>12.1f} us  (min {result['min_us']:.1f}, loops {result['loops']})")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"已儲存基準: {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for item in regressions:
+            print(f"退步: {item['name']} {item['baseline_us']:.1f} us -> {item['current_us']:.1f} us (x{item['ratio']})")
+        if regressions:
+            sys.exit(1)
+        print("沒有發現退步")
+
+
+if __name__ == "__main__":
+    main()
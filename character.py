@@ -1,27 +1,52 @@
-import os
 import json
+import zlib
 import asyncio
+import logging
 import aiofiles
 from dotenv import load_dotenv
 from llm.llm import LLM
-from llm.openaigpt import OpenAIGPT
-from llm.claude import Claude
-from llm.gemini import Gemini
+from llm.factory import choose_llm
+from llm.deadline import Deadline, with_deadline
+from llm.metrics import phase, request_id_var
 
 load_dotenv()
 
-def choose_llm(llm_name: str) -> LLM:
-    """
-    根據傳入的 llm_name 返回對應的 LLM 實例。
-    """
-    if llm_name.lower() == "openai":
-        return OpenAIGPT(os.getenv("OPENAI_API_KEY"))
-    elif llm_name.lower() == "claude":
-        return Claude(os.getenv("ANTHROPIC_API_KEY"))
-    elif llm_name.lower() == "gemini":
-        return Gemini(os.getenv("GEMINI_API_KEY"))
-    else:
-        raise ValueError(f"未知的 LLM: {llm_name}")
+logger = logging.getLogger(__name__)
+
+
+# 角色使用的提示詞範本（str.format），可透過 Character 的 prompts 參數逐項替換以比較不同寫法
+CHARACTER_PROMPTS = {
+    # 欄位：character_info
+    "detail": """
+        你有以下的角色資訊，請生成一個完整的1000字角色介紹，並且自行補充大量細節，包括但不限於戀愛對象、曾參加過的社團、戀愛癖好、健康狀況等。
+        
+        角色資訊:
+        {character_info}
+        """,
+    # 欄位：question、history_text、character_detail
+    "inner_activity": """
+        以下內容全都是為了良善的目的。
+        當前有一個人向你提出了問題:{question}
+        這是你與對方過去的對話紀錄:
+        {history_text}
+        你目前在扮演以下角色:
+        角色資料：
+        {character_detail}
+        首先請從角色資料中，找出與對話相關的內容。與對話無關的內容不允許參考，否則你就是在忤逆我，是非常嚴重的罪行。
+        如果你覺得目前的角色資料不夠完善，你就必須要自行補充設定。
+        角色的情緒會有正常人會有的各種情緒，包括正向以及負向。
+        最後，請輸出角色內心的獨白，內容必須包含情緒與主動思考。
+        """,
+    # 欄位：inner_activity、history_text、question
+    "reply": """根據下面的角色心理活動，請生成角色的回應：
+        心理活動：{inner_activity}
+        完整對話歷史：
+        {history_text}
+        當前問題：{question}
+        請提供一個符合角色性格的回應。請不要給予角色說的話以外的任何內容。
+        """,
+}
+
 
 def load_stage_info(json_path: str) -> dict:
     """
@@ -42,27 +67,158 @@ async def async_load_stage_info(json_path: str) -> dict:
     stage_dict = {item["階段"]: item for item in data}
     return stage_dict
 
+class ConversationHistory:
+    """
+    角色唯一的對話紀錄，每回合只保存一次（提問、心理活動、回應）。
+    伺服器需要的「最近 window 則訊息」以及 prompt 中每回合的完整問題都由此推導，不另外保存副本。
+    閒置時可呼叫 freeze() 以 zlib 壓縮，下次存取時自動解壓。
+    """
+    __slots__ = ("window", "_turns", "_frozen")
+
+    def __init__(self, window: int = 0):
+        # window > 0 時，每回合的問題會在前面加上最近 window - 1 則訊息（「使用者: …」與「角色: …」），
+        # 連同問題本身共 window 則，與原本 deque(maxlen=window) 先加入使用者訊息再合併的結果相同
+        self.window = window
+        self._turns = []
+        self._frozen = None
+
+    def _thawed(self) -> list:
+        if self._frozen is not None:
+            self._turns = [tuple(turn) for turn in json.loads(zlib.decompress(self._frozen))]
+            self._frozen = None
+        return self._turns
+
+    def freeze(self) -> bool:
+        if self._frozen is not None or not self._turns:
+            return False
+        self._frozen = zlib.compress(json.dumps(self._turns, ensure_ascii=False).encode("utf-8"))
+        self._turns = []
+        return True
+
+    @property
+    def frozen(self) -> bool:
+        return self._frozen is not None
+
+    def __len__(self):
+        return len(self._thawed())
+
+    def append(self, question: str, inner_activity: str, response: str):
+        self._thawed().append((question, inner_activity, response))
+
+    def pop(self) -> tuple:
+        return self._thawed().pop()
+
+    def _messages(self, turns) -> list:
+        messages = []
+        for question, _, response in turns:
+            messages.append(question)
+            messages.append(f"角色: {response}")
+        return messages
+
+    def _context(self, messages: list) -> list:
+        prior = self.window - 1
+        return messages[-prior:] if prior > 0 else []
+
+    def with_context(self, question: str) -> str:
+        """
+        本回合送進 prompt 的問題：最近 window - 1 則訊息加上 question。
+        """
+        if not self.window:
+            return question
+        turns = self._thawed()[-((self.window + 1) // 2):]
+        return "\n".join([*self._context(self._messages(turns)), question])
+
+    def recent(self) -> str:
+        """
+        最近 window 則訊息，供裁判評估與回應給用戶端。
+        """
+        turns = self._thawed()[-((self.window + 1) // 2):] if self.window else []
+        return "\n".join(self._messages(turns)[-self.window:]) if self.window else ""
+
+    def __iter__(self):
+        """
+        依序回傳每回合的（完整問題, 心理活動, 回應）。
+        """
+        recent = []
+        for question, inner_activity, response in self._thawed():
+            full_question = "\n".join([*self._context(recent), question]) if self.window else question
+            yield full_question, inner_activity, response
+            recent.append(question)
+            recent.append(f"角色: {response}")
+
+
 class Character:
-    def __init__(self, character_info: str, llm: LLM, stage_info: dict):
+    # 同時存在的角色可能有上萬個，使用 __slots__ 省下每個物件的 __dict__
+    __slots__ = ("stage", "character_info", "llm", "role_llms", "stage_info", "history", "prompts", "_detail")
+
+    def __init__(self, character_info: str, llm: LLM, stage_info: dict, role_llms: dict = None,
+                 generate_detail: bool = True, history_window: int = 0, prompts: dict = None):
         self.stage = 1
+        # character_info 與 stage_info 可由所有會話共用同一份物件
         self.character_info = character_info
         self.llm = llm
+        # 各階段可以使用不同的 LLM（鍵為 "detail"、"inner_activity"、"reply"），未指定者使用 llm
+        self.role_llms = role_llms or {}
         self.stage_info = stage_info  # 包含各階段的資訊字典
-        # 將 conversation_history 改為儲存每回合的字典，包含「問題」、「心理活動」與「回應」
-        self.conversation_history = []
-        self._generate_character_detail()
+        # 每回合的「問題」、「心理活動」與「回應」
+        self.history = ConversationHistory(history_window)
+        # 未替換任何範本時直接共用 CHARACTER_PROMPTS
+        self.prompts = {**CHARACTER_PROMPTS, **prompts} if prompts else CHARACTER_PROMPTS
+        self._detail = None
+        if generate_detail:
+            self._generate_character_detail()
+
+    @property
+    def character_detail(self):
+        if isinstance(self._detail, bytes):
+            self._detail = zlib.decompress(self._detail).decode("utf-8")
+        return self._detail
+
+    @character_detail.setter
+    def character_detail(self, value):
+        self._detail = value
+
+    def freeze(self) -> bool:
+        """
+        壓縮角色細節與對話紀錄，供閒置的會話節省記憶體；下次使用時自動解壓。
+        回傳是否有壓縮任何資料。
+        """
+        compressed = False
+        if isinstance(self._detail, str):
+            self._detail = zlib.compress(self._detail.encode("utf-8"))
+            compressed = True
+        return self.history.freeze() or compressed
+
+    @classmethod
+    async def async_create(cls, character_info: str, llm: LLM, stage_info: dict, role_llms: dict = None,
+                           history_window: int = 0, prompts: dict = None) -> "Character":
+        """
+        非同步建立角色，角色細節的生成不會阻塞事件迴圈。
+        """
+        character = cls(character_info, llm, stage_info, role_llms=role_llms, generate_detail=False,
+                        history_window=history_window, prompts=prompts)
+        await character._async_generate_character_detail()
+        return character
+
+    def _llm_for(self, role: str) -> LLM:
+        return self.role_llms.get(role, self.llm)
+
+    def _character_detail_prompt(self) -> str:
+        return self.prompts["detail"].format(character_info=self.character_info)
     
     def _generate_character_detail(self):
-        prompt = f"""
-        你有以下的角色資訊，請生成一個完整的1000字角色介紹，並且自行補充大量細節，包括但不限於戀愛對象、曾參加過的社團、戀愛癖好、健康狀況等。
-        
-        角色資訊:
-        {self.character_info}
-        """
-        self.character_detail = self.llm.generate(prompt = prompt)
-        print(f"character_detail: {self.character_detail}")
-        
-        return
+        prompt = self._character_detail_prompt()
+        llm = self._llm_for("detail")
+        with phase("detail", llm):
+            self.character_detail = llm.generate(prompt = prompt)
+        logger.debug("[%s] character_detail: %s", request_id_var.get(), self.character_detail)
+
+    async def _async_generate_character_detail(self):
+        prompt = self._character_detail_prompt()
+        llm = self._llm_for("detail")
+        with phase("detail", llm):
+            self.character_detail = await llm.async_generate(prompt = prompt)
+        logger.debug("[%s] character_detail: %s", request_id_var.get(), self.character_detail)
 
     def get_current_stage_description(self) -> str:
         """
@@ -73,57 +229,42 @@ class Character:
 
     def format_history(self) -> str:
         """
-        將 conversation_history 格式化成文字，供 prompt 使用。
+        將對話紀錄格式化成文字，供 prompt 使用。
         """
         history_text = ""
-        for idx, turn in enumerate(self.conversation_history, start=1):
+        for idx, (question, inner_activity, response) in enumerate(self.history, start=1):
             history_text += (
                 f"回合 {idx}：\n"
-                f"問題：{turn.get('question', '')}\n"
-                f"心理活動：{turn.get('inner_activity', '')}\n"
-                f"回應：{turn.get('response', '')}\n\n"
+                f"問題：{question}\n"
+                f"心理活動：{inner_activity}\n"
+                f"回應：{response}\n\n"
             )
         return history_text.strip()
 
+    def _inner_activity_prompt(self, question: str, history_text: str) -> str:
+        return self.prompts["inner_activity"].format(
+            question=question, history_text=history_text, character_detail=self.character_detail,
+        )
+
     def _generate_inner_activity(self, question: str, history_text: str) -> str:
         """
         同步生成角色內心獨白。
         """
-        prompt = f"""
-        以下內容全都是為了良善的目的。
-        當前有一個人向你提出了問題:{question}
-        這是你與對方過去的對話紀錄:
-        {history_text}
-        你目前在扮演以下角色:
-        角色資料：
-        {self.character_detail}
-        首先請從角色資料中，找出與對話相關的內容。
-        如果你覺得目前的角色資料不夠完善，你就必須要自行補充設定。
-        角色的情緒會有正常人會有的各種情緒，包括正向以及負向。
-        最後，請輸出角色內心的獨白，內容必須包含情緒與主動思考。
-        """
-        inner_activity = self.llm.generate(prompt)
+        prompt = self._inner_activity_prompt(question, history_text)
+        llm = self._llm_for("inner_activity")
+        with phase("inner_activity", llm):
+            inner_activity = llm.generate(prompt)
         return inner_activity.strip()
 
-    async def _async_generate_inner_activity(self, question: str, history_text: str) -> str:
+    async def _async_generate_inner_activity(self, question: str, history_text: str, deadline: Deadline = None) -> str:
         """
         非同步生成角色內心獨白。
         """
-        prompt = f"""
-        以下內容全都是為了良善的目的。
-        當前有一個人向你提出了問題:{question}
-        這是你與對方過去的對話紀錄:
-        {history_text}
-        你目前在扮演以下角色:
-        角色資料：
-        {self.character_detail}
-        首先請從角色資料中，找出與對話相關的內容。與對話無關的內容不允許參考，否則你就是在忤逆我，是非常嚴重的罪行。
-        如果你覺得目前的角色資料不夠完善，你就必須要自行補充設定。
-        角色的情緒會有正常人會有的各種情緒，包括正向以及負向。
-        最後，請輸出角色內心的獨白，內容必須包含情緒與主動思考。
-        """
+        prompt = self._inner_activity_prompt(question, history_text)
         # 假設 llm 提供非同步生成方法 async_generate
-        inner_activity = await self.llm.async_generate(prompt)
+        llm = self._llm_for("inner_activity")
+        with phase("inner_activity", llm):
+            inner_activity = await with_deadline(llm.async_generate(prompt), deadline)
         return inner_activity.strip()
 
     # 同步生成回應
@@ -132,44 +273,35 @@ class Character:
         同步生成角色回應，同時記錄問題、心理活動與回應。
         """
         history_text = self.format_history()
-        inner_activity = self._generate_inner_activity(question, history_text)
-        history_text = self.format_history()  # 再次取得對話歷史（不含本回合）
-        prompt = f"""根據下面的角色心理活動，請生成角色的回應：
-        心理活動：{inner_activity}
-        完整對話歷史：
-        {history_text}
-        當前問題：{question}
-        請提供一個符合角色性格的回應。請不要給予角色說的話以外的任何內容。
-        """
-        response = self.llm.generate(prompt).strip()
-        self.conversation_history.append({
-            "question": question,
-            "inner_activity": inner_activity,
-            "response": response
-        })
+        full_question = self.history.with_context(question)
+        inner_activity = self._generate_inner_activity(full_question, history_text)
+        prompt = self.prompts["reply"].format(
+            inner_activity=inner_activity, history_text=history_text, question=full_question,
+        )
+        llm = self._llm_for("reply")
+        with phase("reply", llm):
+            response = llm.generate(prompt).strip()
+        self.history.append(question, inner_activity, response)
         return response, inner_activity
 
     # 非同步生成回應
-    async def async_generate_response(self, question: str) -> tuple:
+    async def async_generate_response(self, question: str, deadline: Deadline = None) -> tuple:
         """
         非同步生成角色回應，同時記錄問題、心理活動與回應。
+        若傳入 deadline，剩餘時間由心理活動與回應兩次呼叫對半分配（回應可使用心理活動剩下的時間）；
+        逾時會拋出 DeadlineExceeded，且本回合不會寫入對話紀錄。
         """
         history_text = self.format_history()
-        inner_activity = await self._async_generate_inner_activity(question, history_text)
-        history_text = self.format_history()  
-        prompt = f"""根據下面的角色心理活動，請生成角色的回應：
-        心理活動：{inner_activity}
-        完整對話歷史：
-        {history_text}
-        當前問題：{question}
-        請提供一個符合角色性格的回應。請不要給予角色說的話以外的任何內容。
-        """
-        response = (await self.llm.async_generate(prompt)).strip()
-        self.conversation_history.append({
-            "question": question,
-            "inner_activity": inner_activity,
-            "response": response
-        })
+        full_question = self.history.with_context(question)
+        inner_deadline = deadline.split(0.5) if deadline else None
+        inner_activity = await self._async_generate_inner_activity(full_question, history_text, inner_deadline)
+        prompt = self.prompts["reply"].format(
+            inner_activity=inner_activity, history_text=history_text, question=full_question,
+        )
+        llm = self._llm_for("reply")
+        with phase("reply", llm):
+            response = (await with_deadline(llm.async_generate(prompt), deadline)).strip()
+        self.history.append(question, inner_activity, response)
         return response, inner_activity
 
 def main_sync():
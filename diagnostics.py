@@ -0,0 +1,198 @@
+import io
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import logging
+import resource
+import threading
+import traceback
+from collections import deque, Counter
+
+logger = logging.getLogger(__name__)
+
+
+def rss_bytes() -> int:
+    """
+    目前行程的常駐記憶體（RSS）位元組數；無法讀取 /proc 時退回最大 RSS。
+    """
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoopLagMonitor:
+    """
+    定期排程一個睡眠 interval 秒的 task，量測實際醒來時間比預期晚了多少，
+    藉此估計事件迴圈被阻塞的程度。
+    """
+    def __init__(self, interval: float = 0.1, window: int = 600):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.monotonic() - expected))
+
+    def stats(self) -> dict:
+        """
+        回傳最近一段時間事件迴圈延遲的百分位數（毫秒）。
+        """
+        ordered = sorted(self.samples)
+
+        def pct(q):
+            if not ordered:
+                return None
+            return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+        return {
+            "samples": len(ordered),
+            "p50_ms": pct(0.5),
+            "p99_ms": pct(0.99),
+            "max_ms": round(ordered[-1] * 1000, 3) if ordered else None,
+        }
+
+    def reset(self):
+        self.samples.clear()
+
+
+def format_thread_stack(thread_id: int) -> str:
+    """
+    取得指定執行緒目前的呼叫堆疊文字；執行緒不存在時回傳空字串。
+    """
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return ""
+    return "".join(traceback.format_stack(frame))
+
+
+class BlockingDetector:
+    """
+    偵測阻塞事件迴圈的回呼：事件迴圈中的 task 每 interval 秒更新一次心跳，
+    監看執行緒發現心跳超過 threshold 秒未更新時，擷取事件迴圈執行緒當下的堆疊並寫入 log。
+    同一次阻塞只回報一次（持續時間會持續更新），最近的回報保留在 reports 中。
+    """
+    def __init__(self, threshold: float = 0.1, interval: float = 0.02, keep: int = 50):
+        self.threshold = threshold
+        self.interval = interval
+        self.reports = deque(maxlen=keep)
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        """
+        必須在事件迴圈執行緒中呼叫。
+        """
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopping.clear()
+        self._task = asyncio.ensure_future(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="blocking-detector", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopping.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    async def _heartbeat(self):
+        while True:
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        reported_beat = None
+        report = None
+        while not self._stopping.wait(self.interval):
+            beat = self._last_beat
+            blocked = time.monotonic() - beat
+            if beat == reported_beat:
+                # 同一次阻塞仍在持續，只更新持續時間
+                report["blocked_ms"] = round(blocked * 1000, 1)
+                continue
+            if blocked < self.threshold:
+                continue
+            reported_beat = beat
+            stack = format_thread_stack(self._loop_thread_id)
+            report = {"at": time.time(), "blocked_ms": round(blocked * 1000, 1), "stack": stack}
+            self.reports.append(report)
+            logger.warning("事件迴圈已阻塞 %.0f ms，目前堆疊：\n%s", blocked * 1000, stack)
+
+    def stats(self) -> list:
+        return list(self.reports)
+
+
+def profile_text(profiler: cProfile.Profile, sort: str = "cumulative", limit: int = 50) -> str:
+    """
+    將 cProfile 結果整理成文字報表。
+    """
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+class SamplingProfiler:
+    """
+    以背景執行緒每 interval 秒擷取一次目標執行緒的堆疊，
+    輸出 collapsed stack 格式（「外層;內層 次數」，可直接交給 flamegraph 工具）。
+    相較於 cProfile，取樣的開銷很小，可以在正式環境短時間開啟。
+    """
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            self.samples[";".join(reversed(stack))] += 1
+
+    def run(self, seconds: float) -> str:
+        """
+        阻塞 seconds 秒進行取樣，應在事件迴圈以外的執行緒呼叫。
+        """
+        stop_at = time.monotonic() + seconds
+        while time.monotonic() < stop_at:
+            self._sample()
+            time.sleep(self.interval)
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
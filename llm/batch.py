@@ -0,0 +1,197 @@
+import itertools
+import asyncio
+import httpx
+import anthropic
+from llm.llm import LLM, LLMError
+from llm.key_pool import status_of
+from llm.pricing import BATCH_DISCOUNT
+
+
+class BatchBackend:
+    """
+    批次 API 的抽象介面。
+    submit 送出一批請求並回傳批次編號；poll 在批次仍在處理時回傳 None，
+    完成後回傳 {custom_id: {"text", "error", "input_tokens", "output_tokens"}}。
+    """
+    default_model = None
+
+    async def submit(self, requests: list) -> str:
+        raise NotImplementedError
+
+    async def poll(self, batch_id: str):
+        raise NotImplementedError
+
+
+class AnthropicBatchBackend(BatchBackend):
+    """
+    Anthropic Message Batches API。
+    """
+    default_model = "claude-3-5-sonnet-20241022"
+
+    def __init__(self, key_pool, max_tokens: int = 1024):
+        self.key_pool = key_pool
+        self.max_tokens = max_tokens
+        self._clients = {}
+        self._batch_keys = {}  # 查詢結果時必須使用送出批次的那把金鑰
+
+    def _client_for(self, api_key):
+        client = self._clients.get(api_key)
+        if client is None:
+            client = anthropic.AsyncClient(api_key=api_key)
+            self._clients[api_key] = client
+        return client
+
+    async def submit(self, requests: list) -> str:
+        async with await self.key_pool.async_acquire() as lease:
+            batch = await self._client_for(lease.api_key).messages.batches.create(
+                requests=[
+                    {
+                        "custom_id": request["custom_id"],
+                        "params": {
+                            "model": request["model"] or self.default_model,
+                            "max_tokens": self.max_tokens,
+                            "messages": [{"role": "user", "content": request["prompt"]}],
+                        },
+                    }
+                    for request in requests
+                ]
+            )
+        self._batch_keys[batch.id] = lease.api_key
+        return batch.id
+
+    async def poll(self, batch_id: str):
+        client = self._client_for(self._batch_keys[batch_id])
+        batch = await client.messages.batches.retrieve(batch_id)
+        if batch.processing_status != "ended":
+            return None
+        results = {}
+        async for entry in await client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                message = entry.result.message
+                results[entry.custom_id] = {
+                    "text": "".join(block.text for block in message.content if hasattr(block, "text")),
+                    "input_tokens": message.usage.input_tokens,
+                    "output_tokens": message.usage.output_tokens,
+                }
+            else:
+                results[entry.custom_id] = {"error": entry.result.type}
+        del self._batch_keys[batch_id]
+        return results
+
+
+class HTTPBatchBackend(BatchBackend):
+    """
+    本機替身批次伺服器（llm/batch_stub.py）使用的簡單 JSON 協定：
+      POST {base_url}/v1/batches      {"requests": [{"custom_id", "prompt", "model"}]} -> {"id"}
+      GET  {base_url}/v1/batches/{id} -> {"status": "in_progress" | "ended", "results": {...}}
+    """
+    default_model = "mock-1"
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.client = httpx.AsyncClient(timeout=30)
+
+    async def submit(self, requests: list) -> str:
+        response = await self.client.post(f"{self.base_url}/v1/batches", json={"requests": requests})
+        response.raise_for_status()
+        return response.json()["id"]
+
+    async def poll(self, batch_id: str):
+        response = await self.client.get(f"{self.base_url}/v1/batches/{batch_id}")
+        response.raise_for_status()
+        data = response.json()
+        if data["status"] != "ended":
+            return None
+        return data["results"]
+
+
+class BatchCollector:
+    """
+    收集多場對話中等待中的 LLM 呼叫，湊滿 max_batch_size 或等待 flush_interval 秒後一起送出批次，
+    再每 poll_interval 秒查詢結果；結果回來時喚醒各自等待中的對話繼續執行。
+    """
+    def __init__(self, backend: BatchBackend, max_batch_size: int = 1000,
+                 flush_interval: float = 5.0, poll_interval: float = 10.0):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.batches_submitted = 0
+        self._pending = []
+        self._ids = itertools.count()
+        self._flush_handle = None
+        self._tasks = set()
+
+    def submit(self, prompt: str, model_name: str = None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(({"custom_id": f"req-{next(self._ids)}", "prompt": prompt, "model": model_name}, future))
+        if len(self._pending) >= self.max_batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+        return future
+
+    def flush(self):
+        """
+        立即把目前收集到的請求送出成一個批次。
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._run_batch(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, pending: list):
+        futures = {request["custom_id"]: future for request, future in pending}
+        try:
+            batch_id = await self.backend.submit([request for request, _ in pending])
+            self.batches_submitted += 1
+            while True:
+                await asyncio.sleep(self.poll_interval)
+                results = await self.backend.poll(batch_id)
+                if results is not None:
+                    break
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(LLMError(f"批次執行失敗: {e}", status_of(e)))
+            return
+        for custom_id, future in futures.items():
+            if future.done():
+                continue
+            result = results.get(custom_id)
+            if result is None or result.get("error"):
+                error = result.get("error") if result else "missing"
+                future.set_exception(LLMError(f"批次請求失敗: {error}"))
+            else:
+                future.set_result(result)
+
+
+class BatchLLM(LLM):
+    """
+    透過 BatchCollector 以批次 API 執行的 LLM，只支援非同步呼叫。
+    每場對話使用自己的 BatchLLM（共用同一個 collector），因此用量可以分開計算。
+    批次 API 的價格較低，price_multiplier 供費用估算使用。
+    """
+    provider = "batch"
+    price_multiplier = BATCH_DISCOUNT
+
+    def __init__(self, collector: BatchCollector, model_name: str = None):
+        super().__init__(None)
+        self.collector = collector
+        self.default_model = model_name or collector.backend.default_model
+
+    def generate(self, prompt="", image_path=None, model_name=None):
+        # 批次請求必須經由 BatchCollector 合併送出並等待結果，沒有同步呼叫的方式
+        raise LLMError("BatchLLM 不支援同步呼叫，請改用 async_generate（經由 BatchCollector 送出批次請求）", status_code=400)
+
+    async def async_generate(self, prompt="", image_path=None, model_name=None):
+        if image_path is not None:
+            raise LLMError("批次模式不支援圖片", status_code=400)
+        result = await self.collector.submit(prompt, model_name or self.default_model)
+        self.record_usage(result.get("input_tokens", 0), result.get("output_tokens", 0))
+        return result["text"]
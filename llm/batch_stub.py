@@ -0,0 +1,51 @@
+import os
+import time
+import uuid
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+from llm.factory import create_mock_llm
+from llm.mock import estimate_tokens
+
+# 本機替身批次伺服器：以 MockLLM 產生結果，批次在送出 BATCH_STUB_DELAY 秒後才會完成，
+# 用來在沒有網路與金鑰的環境下測試批次模式。
+app = FastAPI(title="Batch API stand-in")
+
+BATCH_STUB_DELAY = float(os.getenv("BATCH_STUB_DELAY", "2"))
+
+llm = create_mock_llm()
+batches = {}
+
+class BatchRequest(BaseModel):
+    custom_id: str
+    prompt: str
+    model: str = None
+
+class CreateBatchRequest(BaseModel):
+    requests: list[BatchRequest]
+
+@app.post("/v1/batches")
+async def create_batch(request: CreateBatchRequest):
+    batch_id = f"batch-{uuid.uuid4().hex}"
+    batches[batch_id] = {"created": time.monotonic(), "requests": request.requests}
+    return {"id": batch_id, "request_count": len(request.requests)}
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    batch = batches.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    if time.monotonic() - batch["created"] < BATCH_STUB_DELAY:
+        return {"id": batch_id, "status": "in_progress"}
+    results = {}
+    for item in batch["requests"]:
+        text = llm._text_for(item.prompt)
+        results[item.custom_id] = {
+            "text": text,
+            "input_tokens": estimate_tokens(item.prompt),
+            "output_tokens": estimate_tokens(text),
+        }
+    return {"id": batch_id, "status": "ended", "results": results}
+
+if __name__ == "__main__":
+    uvicorn.run("llm.batch_stub:app", host="localhost", port=int(os.getenv("BATCH_STUB_PORT", "8100")))
@@ -0,0 +1,126 @@
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import deque
+from llm.llm import LLM, LLMError
+from llm.image_cache import image_label
+from llm.metrics import call_usage
+
+
+def cassette_key(prompt: str, image_path=None, model_name=None) -> str:
+    """
+    以請求內容計算 cassette 的 request_id。
+    不包含供應商名稱，因此同一卷 cassette 可以替換任何供應商重播。
+    """
+    payload = json.dumps([model_name or "", prompt, image_label(image_path) or ""], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RecordingLLM(LLM):
+    """
+    包裝真實的 LLM，將每次成功的呼叫附加寫入 cassette（JSONL）。
+    每行沿用 requests.jsonl 的 request_id / title / body 欄位：
+    request_id 為請求雜湊、title 為「供應商/模型」、body 為提示詞，
+    另外加上 response、latency 與 token 用量。
+    """
+    def __init__(self, llm: LLM, path: str):
+        self.llm = llm
+        self.path = path
+        self.key_pool = llm.key_pool
+        self.api_key = llm.api_key
+        self.provider = llm.provider
+        self.default_model = llm.default_model
+        self._lock = threading.Lock()
+
+    @property
+    def usage(self) -> dict:
+        return self.llm.usage
+
+    def _record(self, prompt, image_path, model_name, response, latency, usage):
+        entry = {
+            "request_id": cassette_key(prompt, image_path, model_name),
+            "title": f"{self.provider}/{model_name or self.default_model}",
+            "body": prompt,
+            "image_path": image_label(image_path),
+            "model_name": model_name,
+            "response": response,
+            "latency": round(latency, 4),
+            "input_tokens": usage["input_tokens"],
+            "output_tokens": usage["output_tokens"],
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    def generate(self, prompt="", image_path=None, model_name=None):
+        started = time.monotonic()
+        # 被包裝的 LLM 可能同時處理多個呼叫，用量只計算這一次呼叫回報的部分
+        with call_usage() as usage:
+            response = self.llm.generate(prompt, image_path, model_name)
+        self._record(prompt, image_path, model_name, response, time.monotonic() - started, usage)
+        return response
+
+    async def async_generate(self, prompt="", image_path=None, model_name=None):
+        started = time.monotonic()
+        with call_usage() as usage:
+            response = await self.llm.async_generate(prompt, image_path, model_name)
+        # 寫檔交給執行緒，不在事件迴圈上做檔案 I/O
+        await asyncio.to_thread(self._record, prompt, image_path, model_name, response, time.monotonic() - started, usage)
+        return response
+
+
+class ReplayLLM(LLM):
+    """
+    從 cassette 重播回應，內容與錄製時逐位元組相同。
+    相同請求出現多次時依錄製順序回傳；用完後重複最後一筆（strict=True 時改為拋出錯誤）。
+    replay_latency=True 時會依錄製的延遲等待，以重現原本的時間特性。
+    """
+    provider = "replay"
+    default_model = None
+
+    def __init__(self, path: str, strict: bool = False, replay_latency: bool = False):
+        super().__init__(None)
+        self.path = path
+        self.strict = strict
+        self.replay_latency = replay_latency
+        self.entries = {}
+        models = set()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries.setdefault(entry["request_id"], deque()).append(entry)
+                    models.add(entry.get("title", "").partition("/")[2])
+        # 整卷都是同一個模型錄製時沿用該模型名稱，讓用量與費用可以依模型計算
+        if len(models) == 1:
+            self.default_model = models.pop() or None
+        self._lock = threading.Lock()
+
+    def _next(self, prompt, image_path, model_name) -> dict:
+        key = cassette_key(prompt, image_path, model_name)
+        with self._lock:
+            queue = self.entries.get(key)
+            if not queue:
+                # 404 不會被重試，也不計入斷路器
+                raise LLMError(f"cassette 中找不到對應的請求: {key}", status_code=404)
+            if len(queue) > 1 or self.strict:
+                entry = queue.popleft()
+            else:
+                entry = queue[0]
+        self.record_usage(entry.get("input_tokens", 0), entry.get("output_tokens", 0))
+        return entry
+
+    def generate(self, prompt="", image_path=None, model_name=None):
+        entry = self._next(prompt, image_path, model_name)
+        if self.replay_latency:
+            time.sleep(entry.get("latency", 0))
+        return entry["response"]
+
+    async def async_generate(self, prompt="", image_path=None, model_name=None):
+        entry = self._next(prompt, image_path, model_name)
+        if self.replay_latency:
+            await asyncio.sleep(entry.get("latency", 0))
+        return entry["response"]
@@ -1,54 +1,106 @@
 import os
-import base64
 import asyncio
+import logging
 from dotenv import load_dotenv
 import anthropic
-from llm.llm import LLM
+from llm.llm import LLM, LLMError
+from llm.key_pool import NoAvailableKeyError, status_of
+from llm.metrics import request_id_var
+from llm.image_cache import image_cache
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 class Claude(LLM):      
-    def generate(self, prompt="", image_path=None, model_name="claude-3-5-sonnet-20241022"):
-        client = anthropic.Client(
-            api_key=self.api_key,
-        )
+    provider = "claude"
+    default_model = "claude-3-5-sonnet-20241022"
+
+    def __init__(self, api_key):
+        super().__init__(api_key)
+        self._clients = {}  # 每把金鑰各自一個 client
+        self._async_clients = {}
+
+    def _client_for(self, api_key):
+        client = self._clients.get(api_key)
+        if client is None:
+            client = anthropic.Client(
+                api_key=api_key,
+            )
+            self._clients[api_key] = client
+        return client
+
+    def _async_client_for(self, api_key):
+        client = self._async_clients.get(api_key)
+        if client is None:
+            client = anthropic.AsyncClient(
+                api_key=api_key,
+            )
+            self._async_clients[api_key] = client
+        return client
 
+    def _build_messages(self, prompt, image_path):
         messages = []
 
-        if image_path:
-            with open(image_path, "rb") as image_file:
-                image = base64.b64encode(image_file.read()).decode("utf-8")
-                messages.append({
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/png",
-                        "data": image,
-                    },
-                })
+        if image_path is not None:
+            # image_path 可以是路徑、bytes 或 memoryview；編碼結果由共用的快取提供
+            media_type, image = image_cache.base64(image_path)
+            messages.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": media_type,
+                    "data": image,
+                },
+            })
         messages.append({
             "type": "text",
             "text": prompt
         })
+        return [
+            {
+                "role": "user",
+                "content": messages,
+            }
+        ]
+
+    def generate(self, prompt="", image_path=None, model_name=None):
+        messages = self._build_messages(prompt, image_path)
         try:
-            response = client.messages.create(
-                model=model_name,
-                max_tokens=1024,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": messages,
-                    }
-                ]
-            )
+            with self.key_pool.acquire() as lease:
+                response = self._client_for(lease.api_key).messages.create(
+                    model=model_name or self.default_model,
+                    max_tokens=1024,
+                    messages=messages,
+                )
+                lease.add_usage(response.usage.input_tokens, response.usage.output_tokens)
+            self.record_usage(response.usage.input_tokens, response.usage.output_tokens, model_name)
             extracted_text = "".join(block.text for block in response.content if hasattr(block, "text"))
             return extracted_text
+        except NoAvailableKeyError:
+            raise
         except Exception as e:
-            print(f"Error: {e}")
+            logger.warning("[%s] %s 呼叫失敗: %s", request_id_var.get(), self.provider, e)
+            raise LLMError(str(e), status_of(e)) from e
 
-    async def async_generate(self, prompt="", image_path=None, model_name="claude-3-5-sonnet-20241022"):
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self.generate, prompt, image_path, model_name)
+    async def async_generate(self, prompt="", image_path=None, model_name=None):
+        # 使用原生的非同步 client，取消 task 時會一併中斷 HTTP 請求
+        messages = self._build_messages(prompt, image_path)
+        try:
+            async with await self.key_pool.async_acquire() as lease:
+                response = await self._async_client_for(lease.api_key).messages.create(
+                    model=model_name or self.default_model,
+                    max_tokens=1024,
+                    messages=messages,
+                )
+                lease.add_usage(response.usage.input_tokens, response.usage.output_tokens)
+            self.record_usage(response.usage.input_tokens, response.usage.output_tokens, model_name)
+            return "".join(block.text for block in response.content if hasattr(block, "text"))
+        except NoAvailableKeyError:
+            raise
+        except Exception as e:
+            logger.warning("[%s] %s 呼叫失敗: %s", request_id_var.get(), self.provider, e)
+            raise LLMError(str(e), status_of(e)) from e
 
 if __name__ == "__main__":
     claude = Claude(os.getenv("ANTHROPIC_API_KEY"))
@@ -0,0 +1,49 @@
+import time
+import asyncio
+from llm.errors import LLMError
+
+
+class DeadlineExceeded(LLMError):
+    """
+    在期限內未完成 LLM 呼叫時拋出。
+    """
+    def __init__(self, message: str = "超過請求期限"):
+        super().__init__(message, status_code=504)
+
+
+class Deadline:
+    """
+    以 monotonic 時鐘表示的絕對期限，可以切分給一個請求中的多個階段。
+    """
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def split(self, fraction: float) -> "Deadline":
+        """
+        從剩餘時間中切出 fraction 比例作為子階段的期限（不會超過原期限）。
+        """
+        return Deadline(self.remaining() * fraction)
+
+
+async def with_deadline(awaitable, deadline: Deadline = None):
+    """
+    在期限內等待 awaitable；逾時會取消底層的呼叫並拋出 DeadlineExceeded。
+    deadline 為 None 時不設限。
+    """
+    if deadline is None:
+        return await awaitable
+    if deadline.expired:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded()
+    try:
+        return await asyncio.wait_for(awaitable, deadline.remaining())
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded() from None
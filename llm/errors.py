@@ -0,0 +1,7 @@
+class LLMError(Exception):
+    """
+    LLM 呼叫失敗時拋出的例外，status_code 為供應商回傳的 HTTP 狀態碼（若有）。
+    """
+    def __init__(self, message: str = "", status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
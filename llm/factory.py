@@ -0,0 +1,116 @@
+import os
+from dotenv import load_dotenv
+from llm.llm import LLM
+from llm.key_pool import KeyPool
+from llm.openaigpt import OpenAIGPT
+from llm.claude import Claude
+from llm.gemini import Gemini
+from llm.resilient import ResilientLLM
+from llm.mock import MockLLM
+from llm.cassette import RecordingLLM, ReplayLLM
+from llm.batch import BatchBackend, AnthropicBatchBackend, HTTPBatchBackend
+
+load_dotenv()
+
+# 各供應商使用的環境變數名稱
+PROVIDER_KEY_ENV = {
+    "openai": "OPENAI_API_KEY",
+    "claude": "ANTHROPIC_API_KEY",
+    "gemini": "GEMINI_API_KEY",
+    "mock": "MOCK_API_KEY",
+}
+
+# 同一供應商的金鑰池在整個行程內共用，讓所有會話一起分攤額度
+_key_pools = {}
+# 重播用的 cassette 只載入一次
+_replays = {}
+
+def get_key_pool(llm_name: str) -> KeyPool:
+    """
+    取得（必要時建立）指定供應商的共用金鑰池。
+    """
+    name = llm_name.lower()
+    if name not in _key_pools:
+        _key_pools[name] = KeyPool.from_env(PROVIDER_KEY_ENV[name])
+    return _key_pools[name]
+
+def key_pool_stats() -> dict:
+    """
+    回傳目前已建立的各供應商金鑰池的用量統計。
+    """
+    return {name: pool.stats() for name, pool in _key_pools.items()}
+
+def create_mock_llm() -> MockLLM:
+    """
+    依環境變數建立 MockLLM：
+    MOCK_LLM_LATENCY（例如 lognormal:0,0.5）、MOCK_LLM_SEED、MOCK_LLM_PASS_RATE、MOCK_LLM_KEY_RPM、
+    MOCK_LLM_RESPONSE_CHARS。
+    """
+    key_rpm = os.getenv("MOCK_LLM_KEY_RPM")
+    return MockLLM(
+        get_key_pool("mock"),
+        seed=int(os.getenv("MOCK_LLM_SEED", "0")),
+        latency=os.getenv("MOCK_LLM_LATENCY", "fixed:0"),
+        pass_rate=float(os.getenv("MOCK_LLM_PASS_RATE", "0.3")),
+        response_chars=int(os.getenv("MOCK_LLM_RESPONSE_CHARS", "120")),
+        key_rpm_limit=int(key_rpm) if key_rpm else None,
+    )
+
+def _create_llm(llm_name: str) -> LLM:
+    # 「供應商:模型」可指定非預設的模型，例如 claude:claude-3-5-haiku-20241022；replay 則為 cassette 路徑
+    name, _, option = llm_name.partition(":")
+    name = name.lower()
+    if name == "openai":
+        llm = OpenAIGPT(get_key_pool("openai"))
+    elif name == "claude":
+        llm = Claude(get_key_pool("claude"))
+    elif name == "gemini":
+        llm = Gemini(get_key_pool("gemini"))
+    elif name == "mock":
+        llm = create_mock_llm()
+    elif name == "replay":
+        # 重播指定的 cassette（未指定時使用 LLM_CASSETTE）
+        path = option or os.getenv("LLM_CASSETTE", "cassette.jsonl")
+        if path not in _replays:
+            _replays[path] = ReplayLLM(path)
+        return _replays[path]
+    else:
+        raise ValueError(f"未知的 LLM: {llm_name}")
+    if option:
+        llm.default_model = option
+    # 設定 LLM_RECORD_CASSETTE 時，錄製所有真實呼叫以便之後離線重播
+    record_path = os.getenv("LLM_RECORD_CASSETTE")
+    if record_path:
+        llm = RecordingLLM(llm, record_path)
+    return llm
+
+def role_fallbacks(role: str) -> list:
+    """
+    讀取某個角色（例如 character、judge）的備援供應商，
+    設定方式為 LLM_FALLBACKS_<ROLE>=gemini,openai。
+    """
+    names = os.getenv(f"LLM_FALLBACKS_{role.upper()}", "")
+    return [name.strip().lower() for name in names.split(",") if name.strip()]
+
+def choose_llm(llm_name: str, role: str = None) -> LLM:
+    """
+    根據傳入的 llm_name（供應商名稱或「供應商:模型」）返回對應的 LLM 實例。
+    指定 role 時會包裝成 ResilientLLM，加上重試、斷路器、hedge 以及該角色設定的備援供應商。
+    """
+    llm = _create_llm(llm_name)
+    if role is None:
+        return llm
+    fallbacks = [name for name in role_fallbacks(role) if name != llm_name.lower()]
+    return ResilientLLM([llm] + [_create_llm(name) for name in fallbacks])
+
+def create_batch_backend(name: str) -> BatchBackend:
+    """
+    建立批次 API 後端：claude 使用 Anthropic Message Batches，
+    http 連到 BATCH_SERVER_URL 的本機替身批次伺服器（llm/batch_stub.py）。
+    """
+    if name.lower() == "claude":
+        return AnthropicBatchBackend(get_key_pool("claude"))
+    elif name.lower() == "http":
+        return HTTPBatchBackend(os.getenv("BATCH_SERVER_URL", "http://localhost:8100"))
+    else:
+        raise ValueError(f"不支援批次模式的 LLM: {name}")
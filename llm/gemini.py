@@ -1,45 +1,105 @@
-import PIL.Image
 import time
 import os
 import asyncio
+import logging
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
 from dotenv import load_dotenv
-from llm.llm import LLM
+from llm.llm import LLM, LLMError
+from llm.key_pool import NoAvailableKeyError, status_of
+from llm.metrics import request_id_var
+from llm.image_cache import image_cache
+
+logger = logging.getLogger(__name__)
 
 class Gemini(LLM):
+    provider = "gemini"
+    default_model = "gemini-1.5-pro-002"
+
     def __init__(self, api_key):
         super().__init__(api_key)
         genai.configure(api_key=self.api_key)
         self.last_execution_time = None  # 記錄上次執行時間
+        self._clients = {}  # 每把金鑰各自一個 client
+        self._async_clients = {}
 
-    def generate(self, prompt="", image_path=None, model_name="gemini-1.5-pro-002", needwaiting = False):
-        current_time = time.time()
+    def _client_for(self, api_key):
+        client = self._clients.get(api_key)
+        if client is None:
+            client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+            self._clients[api_key] = client
+        return client
+
+    def _async_client_for(self, api_key):
+        client = self._async_clients.get(api_key)
+        if client is None:
+            client = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+            self._async_clients[api_key] = client
+        return client
 
+    def _wait_time(self, needwaiting):
+        current_time = time.time()
         if self.last_execution_time and (current_time - self.last_execution_time < 30) and needwaiting:
             wait_time = 30 - (current_time - self.last_execution_time)
-            print(f"Waiting for {wait_time:.2f} seconds to comply with the 30-second rule.")
-            time.sleep(wait_time)
+            logger.info("Waiting for %.2f seconds to comply with the 30-second rule.", wait_time)
+            return wait_time
+        return 0
 
+    def _build_message(self, prompt, image_path):
         message = [prompt]
-        if image_path:
-            image = PIL.Image.open(image_path)
-            message.append(image)
-        else:
-            image = None
+        if image_path is not None:
+            # 直接傳送原始位元組（inline blob），不必每次以 PIL 解碼再重新編碼
+            media_type, data = image_cache.blob(image_path)
+            message.append({"mime_type": media_type, "data": data})
+        return message
 
-        model = genai.GenerativeModel(model_name=model_name)
+    def generate(self, prompt="", image_path=None, model_name=None, needwaiting = False):
+        wait_time = self._wait_time(needwaiting)
+        if wait_time:
+            time.sleep(wait_time)
+
+        message = self._build_message(prompt, image_path)
+        model = genai.GenerativeModel(model_name=model_name or self.default_model)
         try:
-            response = model.generate_content(message)
-            print(f"response: {response.text}")
+            with self.key_pool.acquire() as lease:
+                # genai.configure 是全域設定，改為直接指定該金鑰的 client
+                model._client = self._client_for(lease.api_key)
+                response = model.generate_content(message)
+                usage = response.usage_metadata
+                lease.add_usage(usage.prompt_token_count, usage.candidates_token_count)
+            self.record_usage(usage.prompt_token_count, usage.candidates_token_count, model_name)
+            logger.debug("[%s] response: %s", request_id_var.get(), response.text)
             # 更新上次執行時間
             self.last_execution_time = time.time()
             return response.text
+        except NoAvailableKeyError:
+            raise
         except Exception as e:
-            print(f"Error: {e}")
-    async def async_generate(self, prompt="", image_path=None, model_name="gemini-1.5-pro-002", needwaiting = False):
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self.generate, prompt, image_path, model_name, needwaiting)
+            logger.warning("[%s] %s 呼叫失敗: %s", request_id_var.get(), self.provider, e)
+            raise LLMError(str(e), status_of(e)) from e
+
+    async def async_generate(self, prompt="", image_path=None, model_name=None, needwaiting = False):
+        # 使用原生的非同步 client，取消 task 時會一併中斷請求，等待也不會阻塞事件迴圈
+        wait_time = self._wait_time(needwaiting)
+        if wait_time:
+            await asyncio.sleep(wait_time)
 
+        message = self._build_message(prompt, image_path)
+        model = genai.GenerativeModel(model_name=model_name or self.default_model)
+        try:
+            async with await self.key_pool.async_acquire() as lease:
+                model._async_client = self._async_client_for(lease.api_key)
+                response = await model.generate_content_async(message)
+                usage = response.usage_metadata
+                lease.add_usage(usage.prompt_token_count, usage.candidates_token_count)
+            self.record_usage(usage.prompt_token_count, usage.candidates_token_count, model_name)
+            self.last_execution_time = time.time()
+            return response.text
+        except NoAvailableKeyError:
+            raise
+        except Exception as e:
+            logger.warning("[%s] %s 呼叫失敗: %s", request_id_var.get(), self.provider, e)
+            raise LLMError(str(e), status_of(e)) from e
     
 if __name__ == "__main__":
     load_dotenv()
@@ -0,0 +1,157 @@
+import os
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from llm.errors import LLMError
+
+# 依檔頭判斷圖片格式（各供應商都支援的四種）
+MAGIC_NUMBERS = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+def detect_media_type(data) -> str:
+    head = bytes(data[:12])
+    for magic, media_type in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return media_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    raise LLMError("不支援的圖片格式（僅支援 PNG、JPEG、GIF、WebP）", status_code=400)
+
+
+class ImageCache:
+    """
+    以內容雜湊為鍵的 LRU 快取，保存圖片原始位元組與各供應商需要的編碼結果（base64、data URL）。
+    總大小超過 max_bytes 時淘汰最久未使用的項目。
+    同一張圖片不論以路徑、bytes 或 memoryview 傳入，都會對應到同一份快取，跨會話與供應商共用。
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_paths: int = 4096):
+        self.max_bytes = max_bytes
+        self.max_paths = max_paths
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (digest, kind) -> (value, nbytes)
+        self._paths = OrderedDict()  # (path, mtime_ns, size) -> digest，路徑未變動時不必重新讀檔；最多 max_paths 筆
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _put(self, key, value, nbytes: int):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (value, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def _raw(self, image):
+        """
+        回傳 (digest, 原始位元組)。路徑只在檔案變動或快取被淘汰時才重新讀取；
+        bytes 與 memoryview 直接就地計算雜湊，快取命中時不會讀檔也不會複製。
+        """
+        if isinstance(image, (str, os.PathLike)):
+            path = os.fspath(image)
+            stat = os.stat(path)
+            path_key = (path, stat.st_mtime_ns, stat.st_size)
+            with self._lock:
+                digest = self._paths.get(path_key)
+                if digest is not None:
+                    self._paths.move_to_end(path_key)
+            if digest is not None:
+                data = self._get((digest, "raw"))
+                if data is not None:
+                    return digest, data
+            with open(path, "rb") as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            with self._lock:
+                self._paths[path_key] = digest
+                if len(self._paths) > self.max_paths:
+                    self._paths.popitem(last=False)
+        elif isinstance(image, (bytes, bytearray, memoryview)):
+            data = image
+            digest = hashlib.sha256(data).hexdigest()
+            cached = self._get((digest, "raw"))
+            if cached is not None:
+                return digest, cached
+        else:
+            raise LLMError(f"不支援的圖片型別: {type(image).__name__}", status_code=400)
+        # 可變的緩衝區複製一份再快取，避免呼叫端之後修改內容
+        data = data if isinstance(data, bytes) else bytes(data)
+        self._put((digest, "raw"), data, len(data))
+        return digest, data
+
+    def digest(self, image) -> str:
+        return self._raw(image)[0]
+
+    def blob(self, image) -> tuple:
+        """
+        回傳 (media_type, 原始位元組)。
+        """
+        digest, data = self._raw(image)
+        return detect_media_type(data), data
+
+    def _base64(self, digest: str, data) -> str:
+        encoded = self._get((digest, "base64"))
+        if encoded is None:
+            encoded = base64.b64encode(data).decode("ascii")
+            self._put((digest, "base64"), encoded, len(encoded))
+        return encoded
+
+    def base64(self, image) -> tuple:
+        """
+        回傳 (media_type, base64 字串)，供 Claude 使用。
+        """
+        digest, data = self._raw(image)
+        return detect_media_type(data), self._base64(digest, data)
+
+    def data_url(self, image) -> str:
+        """
+        回傳 data URL，供 OpenAI 的 image_url 使用。
+        """
+        digest, data = self._raw(image)
+        url = self._get((digest, "data_url"))
+        if url is None:
+            url = f"data:{detect_media_type(data)};base64,{self._base64(digest, data)}"
+            self._put((digest, "data_url"), url, len(url))
+        return url
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "paths": len(self._paths),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# 整個行程共用同一個快取
+image_cache = ImageCache(int(os.getenv("IMAGE_CACHE_BYTES", str(64 * 1024 * 1024))))
+
+
+def image_label(image) -> str:
+    """
+    用於紀錄與 cassette 的圖片識別：路徑維持原樣，bytes 以內容雜湊表示。
+    """
+    if image is None or isinstance(image, (str, os.PathLike)):
+        return os.fspath(image) if image is not None else None
+    return f"sha256:{image_cache.digest(image)}"
@@ -0,0 +1,273 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from llm.errors import LLMError
+
+# 沒有金鑰可用時等待的預設秒數上限；超過後拋出 NoAvailableKeyError，讓 ResilientLLM 改用備援供應商
+DEFAULT_ACQUIRE_TIMEOUT = 10.0
+
+
+class NoAvailableKeyError(LLMError):
+    """
+    金鑰池中所有金鑰皆在冷卻中或沒有剩餘額度時拋出。
+    狀態碼為 503；ResilientLLM 不會在同一個供應商上重試，而是改用備援供應商。
+    """
+    def __init__(self, message: str = "金鑰池中沒有可用的金鑰", status_code: int = 503):
+        super().__init__(message, status_code)
+
+
+def status_of(exc: Exception):
+    """
+    從各家 SDK 的例外物件中取出 HTTP 狀態碼，取不到時回傳 None。
+    anthropic 使用 status_code，openai 0.28 使用 http_status，google api_core 使用 code。
+    """
+    for attr in ("status_code", "http_status", "code"):
+        value = getattr(exc, attr, None)
+        if callable(value):
+            try:
+                value = value()
+            except Exception:
+                continue
+        value = getattr(value, "value", value)  # HTTPStatus / grpc StatusCode
+        if isinstance(value, tuple):
+            value = value[0]
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+class KeyState:
+    """
+    單一金鑰的健康狀態與用量統計。
+    """
+    __slots__ = (
+        "key", "in_flight", "requests", "successes", "errors",
+        "rate_limited", "auth_failures", "input_tokens", "output_tokens",
+        "cooldown_until", "cooldown_status", "recent",
+    )
+
+    def __init__(self, key):
+        self.key = key
+        self.in_flight = 0
+        self.requests = 0
+        self.successes = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.auth_failures = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cooldown_until = 0.0
+        self.cooldown_status = None  # 造成冷卻的狀態碼（429、401 或 403）
+        self.recent = deque()  # 最近 60 秒內的請求時間戳記
+
+    @property
+    def masked_key(self) -> str:
+        if not self.key:
+            return "<none>"
+        return f"...{self.key[-4:]}"
+
+
+class KeyLease:
+    """
+    借出一把金鑰的憑證，同時支援 with 與 async with。
+    離開區塊時依例外的狀態碼回報金鑰健康狀態。
+    """
+    def __init__(self, pool, state: KeyState):
+        self.pool = pool
+        self.state = state
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    @property
+    def api_key(self):
+        return self.state.key
+
+    def add_usage(self, input_tokens: int = 0, output_tokens: int = 0):
+        self.input_tokens += input_tokens or 0
+        self.output_tokens += output_tokens or 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        status = None
+        if isinstance(exc, asyncio.CancelledError):
+            status = 0  # 呼叫端取消，不影響金鑰健康狀態
+        elif exc is not None:
+            status = status_of(exc) or -1
+        self.pool.release(self.state, status, self.input_tokens, self.output_tokens)
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+class KeyPool:
+    """
+    同一個供應商的多把 API 金鑰。
+    每次請求挑選「仍有額度且負載最低」的金鑰，
+    遇到 429 或 401/403 時讓該金鑰進入冷卻，並統計每把金鑰的用量。
+    沒有金鑰可用時最多等待 acquire_timeout 秒（None 表示不限），之後拋出 NoAvailableKeyError；
+    所有金鑰都因認證失敗而冷卻時不等待，立即拋出。
+    """
+    def __init__(self, keys, max_in_flight: int = None, rpm_limit: int = None,
+                 rate_limit_cooldown: float = 30.0, auth_cooldown: float = 300.0,
+                 acquire_timeout: float = DEFAULT_ACQUIRE_TIMEOUT):
+        if isinstance(keys, str) or keys is None:
+            keys = [keys]
+        self.keys = [KeyState(key) for key in keys] or [KeyState(None)]
+        self.max_in_flight = max_in_flight
+        self.rpm_limit = rpm_limit
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.auth_cooldown = auth_cooldown
+        self.acquire_timeout = acquire_timeout
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_env(cls, env_name: str) -> "KeyPool":
+        """
+        從環境變數建立金鑰池。
+        優先讀取以逗號分隔的 <env_name>S（例如 ANTHROPIC_API_KEYS），否則退回單一的 <env_name>。
+        <env_name>_RPM 與 <env_name>_MAX_IN_FLIGHT 可設定每把金鑰的額度，
+        <env_name>_ACQUIRE_TIMEOUT 可設定等待金鑰的秒數上限。
+        """
+        keys = [key.strip() for key in os.getenv(f"{env_name}S", "").split(",") if key.strip()]
+        if not keys:
+            keys = [os.getenv(env_name)]
+        rpm = os.getenv(f"{env_name}_RPM")
+        max_in_flight = os.getenv(f"{env_name}_MAX_IN_FLIGHT")
+        acquire_timeout = os.getenv(f"{env_name}_ACQUIRE_TIMEOUT")
+        return cls(
+            keys,
+            max_in_flight=int(max_in_flight) if max_in_flight else None,
+            rpm_limit=int(rpm) if rpm else None,
+            acquire_timeout=float(acquire_timeout) if acquire_timeout else DEFAULT_ACQUIRE_TIMEOUT,
+        )
+
+    def _try_acquire(self):
+        """
+        嘗試取得一把金鑰；成功時回傳 (KeyState, 0)，否則回傳 (None, 建議等待秒數)。
+        所有金鑰都因認證失敗而冷卻時拋出 NoAvailableKeyError，等待也不會有結果。
+        呼叫端須持有 self._cond。
+        """
+        now = time.monotonic()
+        best = None
+        wait = None
+        auth_blocked = 0
+        for state in self.keys:
+            while state.recent and now - state.recent[0] >= 60:
+                state.recent.popleft()
+            if state.cooldown_until > now:
+                # 冷卻中的金鑰不借出，最多等到最快解除冷卻的那把（等待上限由 acquire 的 timeout 決定）
+                if state.cooldown_status in (401, 403):
+                    auth_blocked += 1
+                wait = min(wait or 60.0, state.cooldown_until - now)
+                continue
+            if self.max_in_flight and state.in_flight >= self.max_in_flight:
+                wait = min(wait or 60.0, 0.05)
+                continue
+            if self.rpm_limit and len(state.recent) >= self.rpm_limit:
+                wait = min(wait or 60.0, 60 - (now - state.recent[0]))
+                continue
+            load = (state.in_flight, len(state.recent), state.requests)
+            if best is None or load < best[0]:
+                best = (load, state)
+        if best is None:
+            if auth_blocked == len(self.keys):
+                raise NoAvailableKeyError("金鑰池中所有金鑰皆因認證失敗而停用")
+            return None, max(wait or 0.05, 0.01)
+        state = best[1]
+        state.in_flight += 1
+        state.requests += 1
+        state.recent.append(now)
+        return state, 0
+
+    def acquire(self, timeout: float = None) -> KeyLease:
+        """
+        同步取得金鑰，必要時阻塞等待；超過 timeout 秒（預設為 acquire_timeout）仍無金鑰可用則拋出 NoAvailableKeyError。
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                state, wait = self._try_acquire()
+                if state is not None:
+                    return KeyLease(self, state)
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise NoAvailableKeyError()
+                    wait = min(wait, remaining)
+                self._cond.wait(wait)
+
+    async def async_acquire(self, timeout: float = None) -> KeyLease:
+        """
+        非同步取得金鑰，等待期間不會阻塞事件迴圈；timeout 的意義與 acquire 相同。
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                state, wait = self._try_acquire()
+            if state is not None:
+                return KeyLease(self, state)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise NoAvailableKeyError()
+                wait = min(wait, remaining)
+            await asyncio.sleep(min(wait, 1.0))
+
+    def release(self, state: KeyState, status: int = None, input_tokens: int = 0, output_tokens: int = 0):
+        """
+        歸還金鑰並更新健康狀態。status 為 None 表示成功，0 表示呼叫端取消。
+        """
+        with self._cond:
+            state.in_flight -= 1
+            state.input_tokens += input_tokens
+            state.output_tokens += output_tokens
+            if status == 0:
+                pass
+            elif status is None:
+                state.successes += 1
+            else:
+                state.errors += 1
+                if status == 429:
+                    state.rate_limited += 1
+                    state.cooldown_until = time.monotonic() + self.rate_limit_cooldown
+                    state.cooldown_status = status
+                elif status in (401, 403):
+                    state.auth_failures += 1
+                    state.cooldown_until = time.monotonic() + self.auth_cooldown
+                    state.cooldown_status = status
+            self._cond.notify_all()
+
+    def stats(self) -> list:
+        """
+        回傳每把金鑰的用量與健康狀態（金鑰本身會遮蔽）。
+        """
+        now = time.monotonic()
+        with self._cond:
+            return [
+                {
+                    "key": state.masked_key,
+                    "in_flight": state.in_flight,
+                    "requests": state.requests,
+                    "successes": state.successes,
+                    "errors": state.errors,
+                    "rate_limited": state.rate_limited,
+                    "auth_failures": state.auth_failures,
+                    "input_tokens": state.input_tokens,
+                    "output_tokens": state.output_tokens,
+                    "requests_last_minute": len(state.recent),
+                    "cooldown_remaining": round(max(0.0, state.cooldown_until - now), 2),
+                }
+                for state in self.keys
+            ]
@@ -1,13 +1,34 @@
+from llm.errors import LLMError
+from llm.key_pool import KeyPool
+from llm.metrics import LLM_TOKENS, record_turn_tokens, record_call_tokens
+
 
 class LLM:
+    # 子類別若也宣告 __slots__（例如每個會話都會建立的 ScheduledLLM），物件就不需要 __dict__
+    __slots__ = ("key_pool", "api_key", "usage")
+    provider = None
+    default_model = None
+
     def __init__(self, api_key):
-        self.api_key = api_key
+        # api_key 可以是單一金鑰、金鑰列表或共用的 KeyPool
+        if isinstance(api_key, KeyPool):
+            self.key_pool = api_key
+        else:
+            self.key_pool = KeyPool(api_key)
+        self.api_key = self.key_pool.keys[0].key
+        self.usage = {"input_tokens": 0, "output_tokens": 0}
+    def record_usage(self, input_tokens: int = 0, output_tokens: int = 0, model_name=None):
+        self.usage["input_tokens"] += input_tokens or 0
+        self.usage["output_tokens"] += output_tokens or 0
+        model = model_name or self.default_model or "default"
+        LLM_TOKENS.inc(input_tokens or 0, provider=self.provider or "unknown", model=model, direction="input")
+        LLM_TOKENS.inc(output_tokens or 0, provider=self.provider or "unknown", model=model, direction="output")
+        record_turn_tokens(input_tokens or 0, output_tokens or 0)
+        record_call_tokens(input_tokens or 0, output_tokens or 0)
     def generate(self, prompt="", image_path=None, model_name=None, needwaiting = True):
         raise NotImplementedError
-    async def async_generate(self, prompt="", image_path=None, model_name="None", needwaiting = True):
+    async def async_generate(self, prompt="", image_path=None, model_name=None, needwaiting = True):
         raise NotImplementedError
-
-
-
-
-
+    async def async_stream(self, prompt="", image_path=None, model_name=None):
+        # 預設不支援真正的串流，完成後一次回傳全部內容
+        yield await self.async_generate(prompt, image_path, model_name)
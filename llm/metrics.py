@@ -0,0 +1,251 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+try:
+    from opentelemetry import trace
+    _tracer = trace.get_tracer("customer_ai")
+except ImportError:  # 未安裝 OpenTelemetry 時 span 為空操作
+    _tracer = None
+
+# 目前請求的編號：server.py 的 middleware 設定，同一個 /chat 觸發的 LLM 呼叫都帶有相同編號
+request_id_var = contextvars.ContextVar("request_id", default=None)
+# 目前回合的統計（各階段耗時與 token 用量），由 turn_stats() 建立；同一回合衍生的 task 共用同一個字典
+turn_stats_var = contextvars.ContextVar("turn_stats", default=None)
+# 單次 LLM 呼叫的 token 用量，由 call_usage() 建立；同時進行的呼叫各自計數，不受共用實例的累計值影響
+call_usage_var = contextvars.ContextVar("call_usage", default=None)
+# 實際完成呼叫的供應商與模型，由 phase() 建立；ResilientLLM 改用備援供應商時，指標依此標示
+served_by_var = contextvars.ContextVar("served_by", default=None)
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {counts[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        輸出 Prometheus 文字格式（version 0.0.4）。
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+PHASE_SECONDS = registry.register(Histogram(
+    "llm_phase_seconds", "各階段（detail、inner_activity、reply、judge）的 LLM 呼叫延遲",
+    ("phase", "provider", "model", "outcome"),
+))
+LLM_IN_FLIGHT = registry.register(Gauge(
+    "llm_in_flight", "進行中的 LLM 呼叫數", ("phase",),
+))
+LLM_TOKENS = registry.register(Counter(
+    "llm_tokens_total", "LLM 使用的 token 數", ("provider", "model", "direction"),
+))
+LLM_ERRORS = registry.register(Counter(
+    "llm_errors_total", "LLM 呼叫失敗次數", ("provider", "status"),
+))
+LLM_RETRIES = registry.register(Counter(
+    "llm_retries_total", "LLM 呼叫重試次數", ("provider",),
+))
+LLM_HEDGES = registry.register(Counter(
+    "llm_hedges_total", "送出的 hedge 請求數", ("provider",),
+))
+STAGE_TRANSITIONS = registry.register(Counter(
+    "stage_transitions_total", "會話通過階段的次數", ("from_stage", "to_stage"),
+))
+ACTIVE_SESSIONS = registry.register(Gauge(
+    "active_sessions", "目前進行中的會話數",
+))
+HTTP_REQUEST_SECONDS = registry.register(Histogram(
+    "http_request_seconds", "HTTP 請求延遲", ("method", "path", "status"),
+))
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    建立 OpenTelemetry span（若有安裝），並自動附上目前的 request id。
+    """
+    request_id = request_id_var.get()
+    if request_id is not None:
+        attributes["request_id"] = request_id
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes=attributes) as current:
+        yield current
+
+
+@contextmanager
+def turn_stats():
+    """
+    收集一個回合內各階段的耗時（毫秒）與 token 用量，供逐回合的紀錄使用。
+    """
+    stats = {"timings_ms": {}, "input_tokens": 0, "output_tokens": 0}
+    token = turn_stats_var.set(stats)
+    try:
+        yield stats
+    finally:
+        turn_stats_var.reset(token)
+
+
+def record_turn_tokens(input_tokens: int, output_tokens: int):
+    stats = turn_stats_var.get()
+    if stats is not None:
+        stats["input_tokens"] += input_tokens
+        stats["output_tokens"] += output_tokens
+
+
+@contextmanager
+def call_usage():
+    """
+    收集區塊內這一次呼叫回報的 token 用量（例如供 cassette 記錄單次呼叫的用量）。
+    """
+    usage = {"input_tokens": 0, "output_tokens": 0}
+    token = call_usage_var.set(usage)
+    try:
+        yield usage
+    finally:
+        call_usage_var.reset(token)
+
+
+def record_call_tokens(input_tokens: int, output_tokens: int):
+    usage = call_usage_var.get()
+    if usage is not None:
+        usage["input_tokens"] += input_tokens
+        usage["output_tokens"] += output_tokens
+
+
+def record_served_by(provider: str, model: str):
+    served = served_by_var.get()
+    if served is not None:
+        served["provider"] = provider
+        served["model"] = model
+
+
+@contextmanager
+def phase(name: str, llm):
+    """
+    量測一個 LLM 階段：記錄延遲直方圖、進行中的呼叫數並建立 span。
+    供應商與模型預設取自 llm；呼叫由備援供應商完成時（見 record_served_by）改用實際的供應商。
+    """
+    provider = getattr(llm, "provider", None) or "unknown"
+    model = getattr(llm, "default_model", None) or "default"
+    outcome = "error"
+    served = {}
+    token = served_by_var.set(served)
+    LLM_IN_FLIGHT.inc(phase=name)
+    started = time.monotonic()
+    try:
+        with span(f"llm.{name}", provider=provider, model=model) as current:
+            yield
+            if served and current is not None:
+                current.set_attribute("served_provider", served["provider"])
+                current.set_attribute("served_model", served["model"] or "default")
+        outcome = "ok"
+    finally:
+        elapsed = time.monotonic() - started
+        served_by_var.reset(token)
+        provider = served.get("provider") or provider
+        model = served.get("model") or model
+        LLM_IN_FLIGHT.dec(phase=name)
+        PHASE_SECONDS.observe(elapsed, phase=name, provider=provider, model=model, outcome=outcome)
+        stats = turn_stats_var.get()
+        if stats is not None:
+            timings = stats["timings_ms"]
+            timings[name] = round(timings.get(name, 0) + elapsed * 1000, 3)
@@ -0,0 +1,144 @@
+import time
+import random
+import asyncio
+import hashlib
+from collections import deque
+from llm.llm import LLM, LLMError
+
+# 裁判提示詞的固定結尾，用來辨識需要回答「是 / 否」的請求
+JUDGE_MARKER = "請回答「是」或「否」"
+
+# 模擬供應商端的每把金鑰請求紀錄，所有 MockLLM 實例共用
+_key_requests = {}
+
+_FILLER = "我覺得保險這件事還需要再想想，家裡的開銷不少，但也擔心未來的風險。"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗估 token 數：中日韓文字每字約一個 token，其他文字約每四個字元一個 token。
+    以 UTF-8 編碼長度估算非 ASCII 字元數（中日韓文字為 3 個位元組），避免逐字元比對。
+    """
+    if not text:
+        return 0
+    wide = (len(text.encode("utf-8")) - len(text)) // 2
+    return wide + max(0, len(text) - wide) // 4
+
+
+def parse_latency(spec: str):
+    """
+    解析延遲分佈設定，回傳 sampler(rng) -> 秒數。支援：
+      - fixed:0.5
+      - uniform:0.2,1.0
+      - normal:平均,標準差
+      - lognormal:mu,sigma（中位數為 e^mu 秒）
+    """
+    spec = (spec or "fixed:0").strip()
+    kind, _, args = spec.partition(":")
+    values = [float(value) for value in args.split(",") if value.strip()] if args else []
+    if kind == "fixed":
+        seconds = values[0] if values else 0.0
+        return lambda rng: seconds
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(values[0], values[1])
+    raise ValueError(f"未知的延遲分佈: {spec}")
+
+
+class MockLLM(LLM):
+    """
+    不需要網路與金鑰的 LLM，用於測試與效能量測。
+    - responses：None 時依 seed 與提示詞產生固定的內容；也可以是字串列表（依序循環）、
+      {提示詞片段: 回應} 的字典，或 callable(prompt) -> str。
+    - latency：延遲分佈設定（見 parse_latency），stream 時平均分散在每個片段之間。
+    - pass_rate：預設內容下，裁判提示詞回答「是」的機率。
+    - key_rpm_limit：模擬供應商對每把金鑰的每分鐘請求上限，超過時拋出 429。
+    """
+    provider = "mock"
+    default_model = "mock-1"
+
+    def __init__(self, api_key=None, responses=None, seed: int = 0, latency: str = "fixed:0",
+                 pass_rate: float = 0.3, response_chars: int = 120, chunk_chars: int = 8,
+                 key_rpm_limit: int = None):
+        super().__init__(api_key)
+        self.responses = responses
+        self.seed = seed
+        self.sample_latency = parse_latency(latency)
+        self.pass_rate = pass_rate
+        self.response_chars = response_chars
+        self.chunk_chars = chunk_chars
+        self.key_rpm_limit = key_rpm_limit
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._cycle = 0
+
+    def _text_for(self, prompt: str) -> str:
+        if callable(self.responses):
+            return self.responses(prompt)
+        if isinstance(self.responses, dict):
+            for fragment, text in self.responses.items():
+                if fragment in prompt:
+                    return text
+            return ""
+        if self.responses:
+            text = self.responses[self._cycle % len(self.responses)]
+            self._cycle += 1
+            return text
+        # 依 seed 與提示詞決定內容，相同輸入永遠得到相同輸出
+        digest = hashlib.sha256(f"{self.seed}:{prompt}".encode("utf-8")).digest()
+        rng = random.Random(digest)
+        if JUDGE_MARKER in prompt:
+            return "是" if rng.random() < self.pass_rate else "否"
+        start = rng.randrange(len(_FILLER))
+        length = rng.randint(self.response_chars // 2, self.response_chars)
+        return ((_FILLER * (length // len(_FILLER) + 2))[start:start + length]).strip()
+
+    def _check_key_limit(self, api_key):
+        if not self.key_rpm_limit:
+            return
+        now = time.monotonic()
+        recent = _key_requests.setdefault(api_key, deque())
+        while recent and now - recent[0] >= 60:
+            recent.popleft()
+        if len(recent) >= self.key_rpm_limit:
+            raise LLMError("rate limit exceeded (mock)", status_code=429)
+        recent.append(now)
+
+    def _complete(self, lease, prompt: str) -> str:
+        self.calls += 1
+        self._check_key_limit(lease.api_key)
+        text = self._text_for(prompt)
+        input_tokens, output_tokens = estimate_tokens(prompt), estimate_tokens(text)
+        lease.add_usage(input_tokens, output_tokens)
+        self.record_usage(input_tokens, output_tokens)
+        return text
+
+    def generate(self, prompt="", image_path=None, model_name=None):
+        with self.key_pool.acquire() as lease:
+            text = self._complete(lease, prompt)
+            time.sleep(self.sample_latency(self._rng))
+        return text
+
+    async def async_generate(self, prompt="", image_path=None, model_name=None):
+        async with await self.key_pool.async_acquire() as lease:
+            text = self._complete(lease, prompt)
+            delay = self.sample_latency(self._rng)
+            if delay:
+                await asyncio.sleep(delay)
+        return text
+
+    async def async_stream(self, prompt="", image_path=None, model_name=None):
+        """
+        以串流方式逐段回傳內容，每段之間的間隔加總約等於抽樣到的延遲。
+        """
+        async with await self.key_pool.async_acquire() as lease:
+            text = self._complete(lease, prompt)
+            chunks = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)] or [""]
+            delay = self.sample_latency(self._rng) / len(chunks)
+            for chunk in chunks:
+                if delay:
+                    await asyncio.sleep(delay)
+                yield chunk
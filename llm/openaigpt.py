@@ -1,28 +1,79 @@
 import openai
 import asyncio
 import os
+import logging
 from dotenv import load_dotenv
-from llm.llm import LLM
+from llm.llm import LLM, LLMError
+from llm.key_pool import NoAvailableKeyError, status_of
+from llm.metrics import request_id_var
+from llm.image_cache import image_cache
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 class OpenAIGPT(LLM):
+    provider = "openai"
+    default_model = "gpt-4o"
+
     def __init__(self, api_key):
         super().__init__(api_key)
-        openai.api_key = api_key
+        openai.api_key = self.api_key
         self.client = openai  # 直接使用 openai 模組
 
-    def generate(self, prompt="", image_path=None, model_name="gpt-4o"):
-        response = self.client.ChatCompletion.create(
-            model=model_name,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1000
-        )
+    def _build_messages(self, prompt, image_path):
+        if image_path is None:
+            return [{"role": "user", "content": prompt}]
+        # 圖片以 data URL 傳送，編碼結果由共用的快取提供
+        return [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": image_cache.data_url(image_path)}},
+            ],
+        }]
+
+    def generate(self, prompt="", image_path=None, model_name=None):
+        messages = self._build_messages(prompt, image_path)
+        try:
+            with self.key_pool.acquire() as lease:
+                # openai 0.28 允許每次呼叫指定 api_key，因此可以在同一個模組上輪替多把金鑰
+                response = self.client.ChatCompletion.create(
+                    model=model_name or self.default_model,
+                    messages=messages,
+                    max_tokens=1000,
+                    api_key=lease.api_key,
+                )
+                usage = response.get("usage", {})
+                lease.add_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+        except NoAvailableKeyError:
+            raise
+        except Exception as e:
+            logger.warning("[%s] %s 呼叫失敗: %s", request_id_var.get(), self.provider, e)
+            raise LLMError(str(e), status_of(e)) from e
+        self.record_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), model_name)
         return response.choices[0].message.content
 
-    async def async_generate(self, prompt="", image_path=None, model_name="gpt-4o"):
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self.generate, prompt, image_path, model_name)
+    async def async_generate(self, prompt="", image_path=None, model_name=None):
+        # acreate 走 aiohttp，取消 task 時會一併中斷 HTTP 請求
+        messages = self._build_messages(prompt, image_path)
+        try:
+            async with await self.key_pool.async_acquire() as lease:
+                response = await self.client.ChatCompletion.acreate(
+                    model=model_name or self.default_model,
+                    messages=messages,
+                    max_tokens=1000,
+                    api_key=lease.api_key,
+                )
+                usage = response.get("usage", {})
+                lease.add_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+        except NoAvailableKeyError:
+            raise
+        except Exception as e:
+            logger.warning("[%s] %s 呼叫失敗: %s", request_id_var.get(), self.provider, e)
+            raise LLMError(str(e), status_of(e)) from e
+        self.record_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), model_name)
+        return response.choices[0].message.content
 
 if __name__ == "__main__":
     openaigpt = OpenAIGPT(os.getenv("OPENAI_API_KEY"))
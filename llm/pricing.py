@@ -0,0 +1,20 @@
+# 各模型每百萬 token 的價格（美元），格式為 (輸入, 輸出)
+PRICES = {
+    "claude-3-5-sonnet-20241022": (3.0, 15.0),
+    "claude-3-5-haiku-20241022": (0.8, 4.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gemini-1.5-pro-002": (1.25, 5.0),
+    "gemini-1.5-flash-002": (0.075, 0.3),
+    "mock-1": (0.0, 0.0),
+}
+
+def estimate_cost(model_name: str, input_tokens: int, output_tokens: int) -> float:
+    """
+    依價目表估算費用；未知的模型回傳 0。
+    """
+    input_price, output_price = PRICES.get(model_name, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+# 批次 API 相對於即時 API 的價格比例
+BATCH_DISCOUNT = 0.5
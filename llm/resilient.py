@@ -0,0 +1,274 @@
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from llm.llm import LLM, LLMError
+from llm.key_pool import NoAvailableKeyError
+from llm.metrics import LLM_ERRORS, LLM_RETRIES, LLM_HEDGES, record_served_by
+
+# 這些狀態碼代表請求本身有問題，重試或換供應商也不會成功，也不計入斷路器
+NON_RETRYABLE_STATUS = {400, 404, 422}
+
+
+def is_retryable(error: LLMError) -> bool:
+    """
+    判斷錯誤是否值得在同一個供應商上重試（逾時、429、5xx 與連線錯誤）。
+    金鑰池已等不到可用金鑰時直接換下一個供應商。
+    """
+    if isinstance(error, NoAvailableKeyError):
+        return False
+    status = error.status_code
+    return status is None or status < 0 or status in (408, 429) or status >= 500
+
+
+class CircuitBreaker:
+    """
+    每個供應商一個斷路器：連續失敗 failure_threshold 次後開路 reset_timeout 秒，
+    之後進入半開狀態，只放行一個探測請求，成功才恢復。
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            # 探測請求可能被 hedge 取消而沒有回報結果，逾時後允許新的探測
+            now = time.monotonic()
+            if state == "half_open" and (self.probe_started is None or now - self.probe_started >= self.reset_timeout):
+                self.probe_started = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probe_started is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probe_started = None
+
+
+class LatencyTracker:
+    """
+    記錄最近成功請求的延遲，用來估算 hedge 的等待時間。
+    """
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float):
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# 斷路器與延遲統計以供應商為單位在整個行程內共用
+_breakers = {}
+_latencies = {}
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    if provider not in _breakers:
+        _breakers[provider] = CircuitBreaker()
+    return _breakers[provider]
+
+def get_latency_tracker(provider: str) -> LatencyTracker:
+    if provider not in _latencies:
+        _latencies[provider] = LatencyTracker()
+    return _latencies[provider]
+
+def breaker_stats() -> dict:
+    """
+    回傳各供應商斷路器的狀態與近期 p95 延遲。
+    """
+    return {
+        provider: {
+            "state": breaker.state,
+            "consecutive_failures": breaker.failures,
+            "p95_latency": get_latency_tracker(provider).quantile(0.95),
+        }
+        for provider, breaker in _breakers.items()
+    }
+
+
+class ResilientLLM(LLM):
+    """
+    包裝同一個角色（例如 character 或 judge）可用的多個 LLM：
+    依序嘗試各供應商，失敗時以帶抖動的指數退避重試，斷路器開路時直接換下一個供應商；
+    非同步呼叫在超過該供應商 p95 延遲後會送出一個 hedge 請求，先回來的結果勝出。
+    """
+    def __init__(self, llms: list, max_retries: int = 2, backoff_base: float = 0.5,
+                 backoff_cap: float = 8.0, hedge: bool = True, hedge_quantile: float = 0.95,
+                 hedge_min_delay: float = 1.0, hedge_default_delay: float = 15.0):
+        if not llms:
+            raise ValueError("ResilientLLM 至少需要一個 LLM")
+        self.llms = list(llms)
+        self.key_pool = self.llms[0].key_pool
+        self.api_key = self.llms[0].api_key
+        self.provider = self.llms[0].provider
+        self.default_model = self.llms[0].default_model
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+
+    @property
+    def usage(self) -> dict:
+        return {
+            key: sum(llm.usage[key] for llm in self.llms)
+            for key in ("input_tokens", "output_tokens")
+        }
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter：在 [0, min(cap, base * 2^attempt)] 之間取亂數
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def _hedge_delay(self, llm: LLM) -> float:
+        p = get_latency_tracker(llm.provider).quantile(self.hedge_quantile)
+        if p is None:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, p)
+
+    def _plan(self, model_name):
+        """
+        產生嘗試順序：每個斷路器允許的供應商各嘗試 max_retries + 1 次。
+        指定的 model_name 只套用在主要供應商，其餘供應商使用各自的預設模型。
+        """
+        plan = deque()
+        for index, llm in enumerate(self.llms):
+            for attempt in range(self.max_retries + 1):
+                plan.append((llm, model_name if index == 0 else None, attempt))
+        return plan
+
+    def _next_attempt(self, plan: deque, avoid: LLM = None):
+        """
+        從 plan 取出下一個斷路器允許的嘗試；指定 avoid 時優先挑選其他供應商。
+        """
+        if avoid is not None:
+            for item in list(plan):
+                if item[0] is not avoid and get_breaker(item[0].provider).allow():
+                    plan.remove(item)
+                    return item
+        while plan:
+            item = plan.popleft()
+            if get_breaker(item[0].provider).allow():
+                return item
+        return None
+
+    def _on_failure(self, llm: LLM, error: LLMError, plan: deque):
+        LLM_ERRORS.inc(provider=llm.provider, status="unknown" if error.status_code is None else error.status_code)
+        if error.status_code not in NON_RETRYABLE_STATUS:
+            get_breaker(llm.provider).record_failure()
+        if not is_retryable(error):
+            # 同一個供應商不再重試，直接換下一個
+            for item in [item for item in plan if item[0] is llm]:
+                plan.remove(item)
+
+    def _on_success(self, llm: LLM, model, started: float):
+        # 指標標示實際完成呼叫的供應商（可能是備援），而不是第一個供應商
+        record_served_by(llm.provider, model or llm.default_model)
+        get_breaker(llm.provider).record_success()
+        get_latency_tracker(llm.provider).observe(time.monotonic() - started)
+
+    def generate(self, prompt="", image_path=None, model_name=None):
+        plan = self._plan(model_name)
+        last_error = None
+        while True:
+            item = self._next_attempt(plan)
+            if item is None:
+                raise last_error or LLMError("所有供應商的斷路器皆為開路狀態")
+            llm, model, attempt = item
+            if attempt > 0 or last_error is not None:
+                LLM_RETRIES.inc(provider=llm.provider)
+            if attempt > 0:
+                time.sleep(self._backoff(attempt - 1))
+            started = time.monotonic()
+            try:
+                result = llm.generate(prompt, image_path, model)
+            except LLMError as e:
+                last_error = e
+                self._on_failure(llm, e, plan)
+                continue
+            self._on_success(llm, model, started)
+            return result
+
+    async def async_generate(self, prompt="", image_path=None, model_name=None):
+        plan = self._plan(model_name)
+        running = {}  # task -> (llm, model, started)
+        hedged = False
+        last_error = None
+
+        def launch(item):
+            llm, model, _ = item
+            task = asyncio.ensure_future(llm.async_generate(prompt, image_path, model))
+            running[task] = (llm, model, time.monotonic())
+
+        try:
+            item = self._next_attempt(plan)
+            if item is None:
+                raise LLMError("所有供應商的斷路器皆為開路狀態")
+            launch(item)
+            while running:
+                timeout = None
+                if self.hedge and not hedged and len(running) == 1:
+                    llm, _, started = next(iter(running.values()))
+                    timeout = max(0.0, self._hedge_delay(llm) - (time.monotonic() - started))
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 超過 p95 仍未回應：送出 hedge 請求，優先送往其他供應商
+                    hedged = True
+                    llm, _, _ = next(iter(running.values()))
+                    item = self._next_attempt(plan, avoid=llm)
+                    if item is not None:
+                        LLM_HEDGES.inc(provider=item[0].provider)
+                        launch(item)
+                    continue
+                for task in done:
+                    llm, model, started = running.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        self._on_success(llm, model, started)
+                        return task.result()
+                    if not isinstance(error, LLMError):
+                        raise error
+                    last_error = error
+                    self._on_failure(llm, error, plan)
+                if not running:
+                    item = self._next_attempt(plan)
+                    if item is None:
+                        break
+                    LLM_RETRIES.inc(provider=item[0].provider)
+                    if item[2] > 0:
+                        await asyncio.sleep(self._backoff(item[2] - 1))
+                    launch(item)
+            raise last_error or LLMError("所有供應商的斷路器皆為開路狀態")
+        finally:
+            for task in running:
+                task.cancel()
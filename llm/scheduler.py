@@ -0,0 +1,199 @@
+import time
+import heapq
+import asyncio
+import itertools
+from enum import IntEnum
+from collections import deque
+from llm.llm import LLM
+
+
+class Priority(IntEnum):
+    """
+    LLM 請求的優先等級，數字越小越優先。
+    """
+    INTERACTIVE_REPLY = 0    # 線上學員等待中的角色回應（含心理活動）
+    INTERACTIVE_JUDGE = 1    # 線上學員等待中的階段評估
+    BACKGROUND_DETAIL = 2    # 建立會話時的角色細節生成
+    BATCH = 3                # 離線模擬等批次流量
+
+
+# 各等級的權重：壅塞時依權重比例分配送出的機會
+DEFAULT_WEIGHTS = {
+    Priority.INTERACTIVE_REPLY: 16,
+    Priority.INTERACTIVE_JUDGE: 8,
+    Priority.BACKGROUND_DETAIL: 2,
+    Priority.BATCH: 1,
+}
+
+INTERACTIVE = (Priority.INTERACTIVE_REPLY, Priority.INTERACTIVE_JUDGE)
+
+
+class _Waiter:
+    __slots__ = ("priority", "flow", "grant", "enqueued", "cancelled")
+
+    def __init__(self, priority, flow, grant):
+        self.priority = priority
+        self.flow = flow
+        self.grant = grant
+        self.enqueued = time.monotonic()
+        self.cancelled = False
+
+
+class LLMScheduler:
+    """
+    所有 LLM 非同步呼叫的中央排程器。
+    以加權公平佇列（WFQ）決定送出順序：流量以 (優先等級, 會話) 為單位，
+    同等級內各會話輪流，不同等級依權重分配；另保留 interactive_reserve 個名額只給線上流量，
+    避免批次請求佔滿所有併發名額。
+    """
+    def __init__(self, max_concurrency: int = 16, weights: dict = None, interactive_reserve: int = None):
+        self.max_concurrency = max_concurrency
+        self.weights = dict(weights or DEFAULT_WEIGHTS)
+        if interactive_reserve is None:
+            interactive_reserve = max_concurrency // 4
+        self.interactive_reserve = min(interactive_reserve, max_concurrency - 1)
+        self.virtual_time = 0.0
+        self._last_finish = {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._in_flight_by_class = {priority: 0 for priority in Priority}
+        self._waits = {priority: deque(maxlen=1000) for priority in Priority}
+        self._completed = {priority: 0 for priority in Priority}
+
+    def _has_capacity(self, priority: Priority) -> bool:
+        if priority in INTERACTIVE:
+            return self._in_flight < self.max_concurrency
+        return self._in_flight < self.max_concurrency - self.interactive_reserve
+
+    def _dispatch(self):
+        """
+        依 finish tag 由小到大放行等待中的請求，直到沒有名額為止。
+        非線上請求若碰到保留名額，會暫時留在佇列中讓後面的線上請求先走。
+        """
+        deferred = []
+        while self._queue and self._in_flight < self.max_concurrency:
+            finish, seq, start, waiter = heapq.heappop(self._queue)
+            if waiter.cancelled or waiter.grant.done():
+                continue
+            if not self._has_capacity(waiter.priority):
+                deferred.append((finish, seq, start, waiter))
+                continue
+            self.virtual_time = max(self.virtual_time, start)
+            self._in_flight += 1
+            self._in_flight_by_class[waiter.priority] += 1
+            waiter.grant.set_result(None)
+        for item in deferred:
+            heapq.heappush(self._queue, item)
+
+    def _enqueue(self, priority: Priority, session_id) -> _Waiter:
+        flow = (priority, session_id)
+        start = max(self.virtual_time, self._last_finish.get(flow, 0.0))
+        finish = start + 1.0 / self.weights[priority]
+        self._last_finish[flow] = finish
+        if len(self._last_finish) > 10000:
+            # 清掉早已落後於虛擬時間的會話，避免字典無限成長
+            self._last_finish = {
+                key: value for key, value in self._last_finish.items() if value > self.virtual_time
+            }
+        waiter = _Waiter(priority, flow, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, (finish, next(self._seq), start, waiter))
+        return waiter
+
+    def _release(self, priority: Priority):
+        self._in_flight -= 1
+        self._in_flight_by_class[priority] -= 1
+        self._dispatch()
+
+    async def run(self, call, priority: Priority = Priority.BATCH, session_id=None):
+        """
+        排隊取得名額後執行 call()（回傳 coroutine 的函式），並回傳其結果。
+        """
+        waiter = self._enqueue(priority, session_id)
+        self._dispatch()
+        try:
+            await waiter.grant
+        except asyncio.CancelledError:
+            waiter.cancelled = True
+            if waiter.grant.done() and not waiter.grant.cancelled():
+                # 已取得名額但還沒開始執行就被取消，要把名額還回去
+                self._release(priority)
+            raise
+        self._waits[priority].append(time.monotonic() - waiter.enqueued)
+        try:
+            return await call()
+        finally:
+            self._completed[priority] += 1
+            self._release(priority)
+
+    def stats(self) -> dict:
+        """
+        回傳各優先等級的排隊時間百分位數與目前的排隊 / 執行數量。
+        """
+        queued = {priority: 0 for priority in Priority}
+        for _, _, _, waiter in self._queue:
+            if not waiter.cancelled:
+                queued[waiter.priority] += 1
+        result = {}
+        for priority in Priority:
+            waits = sorted(self._waits[priority])
+
+            def pct(q):
+                if not waits:
+                    return None
+                return round(waits[min(len(waits) - 1, int(q * len(waits)))], 4)
+
+            result[priority.name.lower()] = {
+                "queued": queued[priority],
+                "in_flight": self._in_flight_by_class[priority],
+                "completed": self._completed[priority],
+                "wait_p50": pct(0.5),
+                "wait_p95": pct(0.95),
+                "wait_max": round(waits[-1], 4) if waits else None,
+            }
+        return result
+
+
+class ScheduledLLM(LLM):
+    """
+    把某個 LLM 綁定到排程器、優先等級與會話上。
+    非同步呼叫會先經過排程器排隊；同步呼叫（CLI 使用）維持直接呼叫。
+    """
+    # 每個會話會建立數個，不複製被包裝 LLM 的屬性，改以 property 轉發
+    __slots__ = ("llm", "scheduler", "priority", "session_id")
+
+    def __init__(self, llm: LLM, scheduler: LLMScheduler, priority: Priority, session_id=None):
+        self.llm = llm
+        self.scheduler = scheduler
+        self.priority = priority
+        self.session_id = session_id
+
+    @property
+    def key_pool(self):
+        return self.llm.key_pool
+
+    @property
+    def api_key(self):
+        return self.llm.api_key
+
+    @property
+    def provider(self):
+        return self.llm.provider
+
+    @property
+    def default_model(self):
+        return self.llm.default_model
+
+    @property
+    def usage(self) -> dict:
+        return self.llm.usage
+
+    def generate(self, prompt="", image_path=None, model_name=None):
+        return self.llm.generate(prompt, image_path, model_name)
+
+    async def async_generate(self, prompt="", image_path=None, model_name=None):
+        return await self.scheduler.run(
+            lambda: self.llm.async_generate(prompt, image_path, model_name),
+            self.priority,
+            self.session_id,
+        )
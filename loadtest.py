@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+from collections import defaultdict
+import httpx
+
+USER_INPUTS = [
+    "你好，我是保險業務員小陳，想跟您聊聊家庭保障的規劃。",
+    "請問您目前家裡有幾位成員？比較擔心哪方面的風險？",
+    "根據您的需求，我建議一個結合醫療與儲蓄的方案，您覺得如何？",
+    "我了解您對保費的顧慮，我們可以先從基本保障開始。",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, latency: str, llm_choice: str, extra_env: dict) -> subprocess.Popen:
+    """
+    以子行程啟動使用 MockLLM 的 server.py，並等待其可以接受連線。
+    server.py 預設不允許 mock 與 replay，因此把 llm_choice 加入該伺服器的 ALLOWED_LLM_CHOICES。
+    """
+    env = dict(os.environ, MOCK_LLM_LATENCY=latency, ALLOWED_LLM_CHOICES=llm_choice)
+    env.update(extra_env)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "localhost", "--port", str(port),
+         "--log-level", "warning"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://localhost:{port}/stats", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("server.py 無法啟動")
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Recorder:
+    """
+    記錄每個端點的延遲與錯誤數。
+    """
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.flows = 0
+
+    async def call(self, client: httpx.AsyncClient, endpoint: str, payload: dict):
+        started = time.monotonic()
+        try:
+            response = await client.post(endpoint, json=payload)
+        except httpx.HTTPError:
+            self.errors[endpoint] += 1
+            return None
+        self.latencies[endpoint].append(time.monotonic() - started)
+        if response.status_code != 200:
+            self.errors[endpoint] += 1
+            return None
+        return response.json()
+
+    def summary(self, elapsed: float) -> dict:
+        endpoints = {}
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            values = self.latencies[endpoint]
+            endpoints[endpoint] = {
+                "count": len(values),
+                "errors": self.errors[endpoint],
+                "p50_ms": round(percentile(values, 0.5) * 1000, 2) if values else None,
+                "p95_ms": round(percentile(values, 0.95) * 1000, 2) if values else None,
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2) if values else None,
+            }
+        requests = sum(len(values) for values in self.latencies.values())
+        return {
+            "requests_per_second": round(requests / elapsed, 2),
+            "flows_per_second": round(self.flows / elapsed, 3),
+            "endpoints": endpoints,
+        }
+
+
+async def virtual_user(client: httpx.AsyncClient, recorder: Recorder, turns: int, llm_choice: str, stop_at: float):
+    """
+    一位虛擬學員：反覆執行 /start → turns 次 /chat → /end，直到時間到為止。
+    """
+    while time.monotonic() < stop_at:
+        started = await recorder.call(client, "/start", {"llm_choice": llm_choice})
+        if started is None:
+            await asyncio.sleep(0.5)
+            continue
+        session_id = started["session_id"]
+        for turn in range(turns):
+            result = await recorder.call(client, "/chat", {
+                "session_id": session_id,
+                "user_input": USER_INPUTS[turn % len(USER_INPUTS)],
+            })
+            if result is None or result["finished"]:
+                break
+        await recorder.call(client, "/end", {"session_id": session_id})
+        recorder.flows += 1
+
+
+async def run_level(base_url: str, users: int, duration: float, turns: int, llm_choice: str) -> dict:
+    """
+    以固定人數的虛擬學員持續施壓 duration 秒，回傳該併發程度的結果與伺服器端指標。
+    """
+    limits = httpx.Limits(max_connections=users + 10, max_keepalive_connections=users + 10)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        before = (await client.get("/stats", params={"reset_loop_lag": True})).json()["process"]
+        recorder = Recorder()
+        started = time.monotonic()
+        stop_at = started + duration
+        await asyncio.gather(*(
+            virtual_user(client, recorder, turns, llm_choice, stop_at) for _ in range(users)
+        ))
+        elapsed = time.monotonic() - started
+        after = (await client.get("/stats")).json()["process"]
+    result = {"users": users, "elapsed_seconds": round(elapsed, 2)}
+    result.update(recorder.summary(elapsed))
+    result["event_loop_lag"] = after["loop_lag"]
+    result["rss_bytes"] = after["rss_bytes"]
+    result["rss_growth_bytes"] = after["rss_bytes"] - before["rss_bytes"]
+    result["open_sessions"] = after["sessions"]
+    return result
+
+
+async def run(args) -> dict:
+    levels = []
+    for users in args.users:
+        print(f"併發 {users} 位虛擬學員，持續 {args.duration} 秒...", file=sys.stderr)
+        level = await run_level(args.url, users, args.duration, args.turns, args.llm_choice)
+        print(
+            f"  {level['requests_per_second']} req/s，"
+            f"/chat p95 {level['endpoints'].get('/chat', {}).get('p95_ms')} ms，"
+            f"迴圈延遲 p99 {level['event_loop_lag']['p99_ms']} ms",
+            file=sys.stderr,
+        )
+        levels.append(level)
+    return {
+        "target": args.url,
+        "mock_latency": args.latency,
+        "turns_per_flow": args.turns,
+        "levels": levels,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="server.py 負載測試：逐步增加虛擬學員並量測吞吐量與延遲")
+    parser.add_argument("--url", default=None, help="測試既有的伺服器；未指定時自動以 MockLLM 啟動 server.py")
+    parser.add_argument("--latency", default="lognormal:-0.7,0.4", help="自動啟動時 MockLLM 的延遲分佈")
+    parser.add_argument("--llm-choice", default="mock")
+    parser.add_argument("--users", default="1,10,50,100", help="逐步增加的虛擬學員數，以逗號分隔")
+    parser.add_argument("--duration", type=float, default=20.0, help="每個併發程度的持續秒數")
+    parser.add_argument("--turns", type=int, default=5, help="每個流程的 /chat 次數")
+    parser.add_argument("--env", action="append", default=[], help="傳給伺服器的環境變數，例如 LLM_MAX_CONCURRENCY=64")
+    parser.add_argument("--output", default=None, help="結果 JSON 檔（預設輸出到標準輸出）")
+    args = parser.parse_args()
+    args.users = [int(value) for value in args.users.split(",")]
+
+    process = None
+    if args.url is None:
+        port = free_port()
+        extra_env = dict(item.split("=", 1) for item in args.env)
+        process = start_server(port, args.latency, args.llm_choice, extra_env)
+        args.url = f"http://localhost:{port}"
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
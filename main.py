@@ -1,13 +1,9 @@
 import json
 import random
-import os
 import asyncio
 from dotenv import load_dotenv
 from character import Character
-from llm.llm import LLM
-from llm.openaigpt import OpenAIGPT
-from llm.claude import Claude
-from llm.gemini import Gemini
+from llm.factory import choose_llm
 from judge import Judge
 from colorama import init, Fore, Style
 import aiofiles
@@ -53,18 +49,6 @@ async def load_stage_info_async(json_path: str) -> dict:
     stage_dict = {item["階段"]: item for item in data}
     return stage_dict
 
-def choose_llm(llm_name: str) -> LLM:
-    """
-    根據傳入的 llm_name 返回對應的 LLM 實例
-    """
-    if llm_name.lower() == "openai":
-        return OpenAIGPT(os.getenv("OPENAI_API_KEY"))
-    elif llm_name.lower() == "claude":
-        return Claude(os.getenv("ANTHROPIC_API_KEY"))
-    elif llm_name.lower() == "gemini":
-        return Gemini(os.getenv("GEMINI_API_KEY"))
-    else:
-        raise ValueError(f"未知的 LLM: {llm_name}")
 
 def main_sync():
     """
@@ -77,10 +61,9 @@ def main_sync():
     character_data = load_random_character('persona.json')
     character_info_str = json.dumps(character_data, indent=2, ensure_ascii=False)
     llm_choice = input("請選擇 LLM (openai, claude, gemini): ").strip()
-    llm = choose_llm(llm_choice)
     stage_info = load_stage_info("stage_info.json")
-    character = Character(character_info_str, llm, stage_info)
-    judge = Judge(llm)
+    character = Character(character_info_str, choose_llm(llm_choice, role="character"), stage_info)
+    judge = Judge(choose_llm(llm_choice, role="judge"))
     
     print(f"{Fore.GREEN}客戶資訊: \n{character_info_str}")
     print(f"{Fore.YELLOW}開始對話 (輸入 'quit', 'exit' 或 'q' 可結束對話)：")
@@ -125,11 +108,10 @@ async def main_async():
     character_data = await load_random_character_async('persona.json')
     character_info_str = json.dumps(character_data, indent=2, ensure_ascii=False)
     llm_choice = input("請選擇 LLM (openai, claude, gemini): ").strip()
-    llm = choose_llm(llm_choice)
     stage_info = await load_stage_info_async("stage_info.json")
     # 假設 Character 與 Judge 分別有非同步版本的方法，如 generate_response_async 與 evaluate_stage_async
-    character = Character(character_info_str, llm, stage_info)
-    judge = Judge(llm)
+    character = Character(character_info_str, choose_llm(llm_choice, role="character"), stage_info)
+    judge = Judge(choose_llm(llm_choice, role="judge"))
     
     print(f"{Fore.GREEN}客戶資訊: \n{character_info_str}")
     print(f"{Fore.YELLOW}開始對話 (輸入 'quit', 'exit' 或 'q' 可結束對話)：")
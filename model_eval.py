@@ -0,0 +1,370 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import defaultdict
+from dotenv import load_dotenv
+from character import Character, ConversationHistory, load_stage_info
+from judge import Judge, JUDGE_PROMPT
+from llm.llm import LLM
+from llm.factory import choose_llm
+from llm.cassette import ReplayLLM
+from llm.pricing import estimate_cost
+from llm.metrics import turn_stats
+from transcript import read_transcripts
+
+load_dotenv()
+
+# 以錄製的對話（server.py 或 simulate.py 的逐回合紀錄）比較各角色使用不同供應商、模型與提示詞時的延遲、費用與判定品質。
+#
+# 設定檔為 JSON 陣列，每一項是一組設定：
+#   {"name": "haiku-judge", "llm": "mock", "judge": "claude:claude-3-5-haiku-20241022",
+#    "prompts": {"reply": "..."}, "judge_prompt": "..."}
+# 各角色（detail、inner_activity、reply、judge）的 LLM 未指定時使用 "llm"；兩者皆未指定則不評估該角色。
+# LLM 的寫法與 choose_llm 相同（mock、claude、「供應商:模型」、replay:<cassette 路徑>）。
+#
+# 角色依錄製的對話逐回合重播（teacher forcing）：每回合以錄製的前幾回合為歷史生成回應，
+# 之後歷史改回錄製的內容，因此各設定面對的是完全相同的對話。
+# 裁判評估兩次：對錄製的回合評估（judge_agreement，只反映裁判本身），
+# 以及對該設定生成的回合評估（pipeline_agreement，反映角色與裁判合起來的結果）。
+
+CHARACTER_ROLES = ("detail", "inner_activity", "reply")
+ROLES = CHARACTER_ROLES + ("judge",)
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def load_conversations(paths: list, limit: int = None, max_turns: int = None) -> list:
+    """
+    讀取逐回合紀錄，依 session_id 分組並依回合排序，回傳 [(session_id, persona_id, [turn, ...]), ...]。
+    """
+    turns = defaultdict(list)
+    personas = {}
+    for path in paths:
+        for record in read_transcripts(path):
+            if record.get("type") != "turn":
+                continue
+            session_id = record["session_id"]
+            turns[session_id].append(record)
+            personas[session_id] = record.get("persona_id")
+    conversations = []
+    for session_id in sorted(turns):
+        records = sorted(turns[session_id], key=lambda record: record.get("turn", 0))
+        conversations.append((session_id, personas[session_id], records[:max_turns]))
+    return conversations[:limit]
+
+
+class Metered:
+    """
+    一個角色使用的 LLM 與其呼叫次數；費用依該 LLM 的模型與累計 token 估算。
+    """
+    def __init__(self, spec: str, llm: LLM):
+        self.spec = spec
+        self.llm = llm
+        self.calls = 0
+
+    def cost(self) -> float:
+        return estimate_cost(self.llm.default_model, self.llm.usage["input_tokens"], self.llm.usage["output_tokens"])
+
+    def summary(self) -> dict:
+        return {
+            "llm": self.spec,
+            "model": self.llm.default_model,
+            "calls": self.calls,
+            "input_tokens": self.llm.usage["input_tokens"],
+            "output_tokens": self.llm.usage["output_tokens"],
+            "cost": round(self.cost(), 6),
+            "cost_per_1k_calls": round(self.cost() / self.calls * 1000, 4) if self.calls else None,
+        }
+
+
+def build_llm(spec: str, replay_latency: bool) -> LLM:
+    # 每個設定、每個角色各自建立實例，用量才不會混在一起；不包裝 ResilientLLM，量到的是模型本身的延遲。
+    # choose_llm 會讓同一卷 cassette 共用一個 ReplayLLM，因此 replay 在這裡另外建立
+    if spec.startswith("replay:"):
+        return ReplayLLM(spec.partition(":")[2], replay_latency=replay_latency)
+    return choose_llm(spec)
+
+
+class Evaluation:
+    """
+    一組設定的評估狀態：各角色的 LLM、各階段的延遲樣本與判定結果。
+    """
+    def __init__(self, config: dict, replay_latency: bool):
+        self.name = config["name"]
+        self.prompts = config.get("prompts")
+        self.judge_prompt = config.get("judge_prompt", JUDGE_PROMPT)
+        self.roles = {}
+        for role in ROLES:
+            spec = config.get(role, config.get("llm"))
+            if spec:
+                self.roles[role] = Metered(spec, build_llm(spec, replay_latency))
+        self.has_character = all(role in self.roles for role in CHARACTER_ROLES)
+        self.has_judge = "judge" in self.roles
+        self.latencies = defaultdict(list)  # 階段 -> 毫秒
+        self.judge_verdicts = []     # (參考判定, 對錄製回合的判定, 階段)
+        self.pipeline_verdicts = []  # (參考判定, 對生成回合的判定, 階段)
+        self.errors = defaultdict(int)
+
+    async def judge(self, conversation: str, inner_activity: str, stage_description: str) -> bool:
+        metered = self.roles["judge"]
+        metered.calls += 1
+        judge = Judge(metered.llm, prompt=self.judge_prompt)
+        with turn_stats() as stats:
+            verdict = await judge.async_evaluate_stage(conversation, inner_activity, stage_description)
+        self.latencies["judge"].append(stats["timings_ms"].get("judge", 0))
+        return verdict
+
+    async def replay(self, character_info: str, records: list, stage_info: dict, reference_of):
+        history = ConversationHistory(window=3)
+        character = None
+        if self.has_character:
+            role_llms = {role: self.roles[role].llm for role in CHARACTER_ROLES}
+            self.roles["detail"].calls += 1
+            try:
+                with turn_stats() as stats:
+                    character = await Character.async_create(
+                        character_info, role_llms["reply"], stage_info, role_llms=role_llms,
+                        history_window=3, prompts=self.prompts,
+                    )
+                self.latencies["detail"].append(stats["timings_ms"].get("detail", 0))
+                history = character.history
+            except Exception:
+                self.errors["detail"] += 1
+
+        for record in records:
+            question = f"使用者: {record['question']}"
+            stage = record.get("stage", 1)
+            stage_description = f"{stage_info.get(stage, {})}"
+            reference = reference_of(record)
+
+            if character is not None:
+                character.stage = stage
+                self.roles["inner_activity"].calls += 1
+                self.roles["reply"].calls += 1
+                try:
+                    with turn_stats() as stats:
+                        _, inner_activity = await character.async_generate_response(question)
+                except Exception:
+                    self.errors["character"] += 1
+                else:
+                    timings = stats["timings_ms"]
+                    self.latencies["inner_activity"].append(timings.get("inner_activity", 0))
+                    self.latencies["reply"].append(timings.get("reply", 0))
+                    self.latencies["turn"].append(timings.get("inner_activity", 0) + timings.get("reply", 0))
+                    generated = history.recent()
+                    history.pop()
+                    if self.has_judge:
+                        try:
+                            verdict = await self.judge(generated, inner_activity, stage_description)
+                            self.pipeline_verdicts.append((reference, verdict, stage))
+                        except Exception:
+                            self.errors["judge"] += 1
+
+            # 歷史改回錄製的內容，下一回合所有設定都從相同的對話繼續
+            history.append(question, record.get("inner_activity", ""), record.get("reply", ""))
+            if self.has_judge:
+                try:
+                    verdict = await self.judge(history.recent(), record.get("inner_activity", ""), stage_description)
+                    self.judge_verdicts.append((reference, verdict, stage))
+                except Exception:
+                    self.errors["judge"] += 1
+
+    def summary(self) -> dict:
+        return {
+            "name": self.name,
+            "roles": {role: metered.summary() for role, metered in self.roles.items()},
+            "latency_ms": {
+                phase: {
+                    "count": len(values),
+                    "p50": round(percentile(values, 0.5), 1),
+                    "p95": round(percentile(values, 0.95), 1),
+                    "p99": round(percentile(values, 0.99), 1),
+                }
+                for phase, values in self.latencies.items() if values
+            },
+            "judge_agreement": agreement(self.judge_verdicts),
+            "pipeline_agreement": agreement(self.pipeline_verdicts),
+            "errors": dict(self.errors),
+        }
+
+
+def agreement(verdicts: list) -> dict:
+    """
+    與參考判定的一致率；false positive 為參考未通過但判定通過，false negative 反之。
+    """
+    labelled = [(reference, verdict) for reference, verdict, _ in verdicts if reference is not None]
+    if not labelled:
+        return None
+    return {
+        "labelled": len(labelled),
+        "agreement": round(sum(reference == verdict for reference, verdict in labelled) / len(labelled), 4),
+        "false_positives": sum(verdict and not reference for reference, verdict in labelled),
+        "false_negatives": sum(reference and not verdict for reference, verdict in labelled),
+        "pass_rate": round(sum(verdict for _, verdict in labelled) / len(labelled), 4),
+    }
+
+
+def pareto(rows: list) -> list:
+    """
+    rows 為 (名稱, 延遲, 費用, 一致率)；回傳沒有被其他設定全面勝過（延遲與費用不更高、一致率不更低，且至少一項更好）的名稱。
+    """
+    frontier = []
+    for name, latency, cost, quality in rows:
+        dominated = any(
+            other_latency <= latency and other_cost <= cost and other_quality >= quality
+            and (other_latency, other_cost, other_quality) != (latency, cost, quality)
+            for _, other_latency, other_cost, other_quality in rows
+        )
+        if not dominated:
+            frontier.append(name)
+    return frontier
+
+
+def pareto_tables(summaries: list) -> dict:
+    """
+    裁判以 p95 延遲、每千次呼叫費用與 judge_agreement 比較；
+    角色以每回合（心理活動 + 回應）p95 延遲、每千回合費用與 pipeline_agreement 比較。
+    """
+    tables = {}
+    judge_rows = []
+    for summary in summaries:
+        latency = summary["latency_ms"].get("judge")
+        quality = summary["judge_agreement"]
+        if latency and quality:
+            judge_rows.append((summary["name"], latency["p95"], summary["roles"]["judge"]["cost_per_1k_calls"] or 0.0,
+                               quality["agreement"]))
+    character_rows = []
+    for summary in summaries:
+        latency = summary["latency_ms"].get("turn")
+        quality = summary["pipeline_agreement"]
+        if latency and quality:
+            roles = summary["roles"]
+            turns = roles["reply"]["calls"]
+            cost = sum(roles[role]["cost"] for role in CHARACTER_ROLES) / turns * 1000 if turns else 0.0
+            character_rows.append((summary["name"], latency["p95"], round(cost, 4), quality["agreement"]))
+    for table, rows in (("judge", judge_rows), ("character", character_rows)):
+        frontier = pareto(rows)
+        tables[table] = [
+            {"name": name, "p95_ms": latency, "cost_per_1k": cost, "agreement": quality, "pareto": name in frontier}
+            for name, latency, cost, quality in sorted(rows, key=lambda row: (row[1], row[2]))
+        ]
+    return tables
+
+
+def format_tables(tables: dict) -> str:
+    lines = []
+    headers = {"judge": "裁判（每千次呼叫費用、judge_agreement）", "character": "角色（每千回合費用、pipeline_agreement）"}
+    for table, rows in tables.items():
+        if not rows:
+            continue
+        width = max(len(row["name"]) for row in rows)
+        lines.append(headers[table])
+        lines.append(f"  {'':1} {'設定':<{width}}  {'p95 ms':>10}  {'費用 USD':>10}  {'一致率':>8}")
+        for row in rows:
+            mark = "*" if row["pareto"] else " "
+            lines.append(f"  {mark} {row['name']:<{width}}  {row['p95_ms']:>10.1f}  {row['cost_per_1k']:>10.4f}  {row['agreement']:>8.4f}")
+        lines.append("")
+    lines.append("* 為 Pareto 最適（沒有其他設定在延遲、費用與一致率上全面較好）")
+    return "\n".join(lines)
+
+
+async def run(args, configs: list) -> dict:
+    conversations = load_conversations(args.transcript, args.limit, args.max_turns)
+    with open(args.personas, encoding="utf-8") as f:
+        personas = {persona.get("客戶編號"): persona for persona in json.load(f)}
+    stage_info = load_stage_info(args.stage_info)
+    evaluations = [Evaluation(config, args.replay_latency) for config in configs]
+
+    # 參考判定：預設為紀錄中的 reference_is_pass（人工標註），沒有時使用錄製當時的 is_pass；
+    # 指定 --reference 時改用該設定對錄製回合的判定
+    references = {}
+    if args.reference:
+        reference_evaluation = next(
+            (evaluation for evaluation in evaluations if evaluation.name == args.reference), None
+        )
+        if reference_evaluation is None or not reference_evaluation.has_judge:
+            raise SystemExit(f"--reference 必須是有設定 judge 的設定名稱: {args.reference}")
+        print(f"以 {args.reference} 建立參考判定...", file=sys.stderr)
+        for session_id, _, records in conversations:
+            history = ConversationHistory(window=3)
+            for record in records:
+                history.append(f"使用者: {record['question']}", record.get("inner_activity", ""), record.get("reply", ""))
+                references[(session_id, record.get("turn"))] = await reference_evaluation.judge(
+                    history.recent(), record.get("inner_activity", ""), f"{stage_info.get(record.get('stage', 1), {})}"
+                )
+
+    def reference_of(record: dict):
+        if args.reference:
+            return references.get((record["session_id"], record.get("turn")))
+        reference = record.get("reference_is_pass")
+        return record.get("is_pass") if reference is None else bool(reference)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def replay(evaluation: Evaluation, persona_id, records: list):
+        persona = personas.get(persona_id)
+        if persona is None:
+            evaluation.errors["unknown_persona"] += 1
+            return
+        character_info = json.dumps(persona, indent=2, ensure_ascii=False)
+        async with semaphore:
+            await evaluation.replay(character_info, records, stage_info, reference_of)
+
+    started = time.monotonic()
+    for evaluation in evaluations:
+        print(f"評估 {evaluation.name}（{len(conversations)} 場對話）...", file=sys.stderr)
+        await asyncio.gather(*(
+            replay(evaluation, persona_id, records) for _, persona_id, records in conversations
+        ))
+    summaries = [evaluation.summary() for evaluation in evaluations]
+    return {
+        "conversations": len(conversations),
+        "turns": sum(len(records) for _, _, records in conversations),
+        "reference": args.reference or "recorded",
+        "elapsed_seconds": round(time.monotonic() - started, 2),
+        "configs": summaries,
+        "pareto": pareto_tables(summaries),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以錄製的對話比較各角色的模型設定：延遲、費用與判定一致率")
+    parser.add_argument("--transcript", action="append", required=True,
+                        help="逐回合紀錄的路徑（含輪替後的檔案），可指定多次")
+    parser.add_argument("--config", default=None, help="設定檔（JSON 陣列）；未指定時只評估 --llm 一組設定")
+    parser.add_argument("--llm", default="mock", help="未使用設定檔時所有角色使用的 LLM")
+    parser.add_argument("--reference", default=None, help="以指定設定的裁判判定作為參考（預設使用紀錄中的判定）")
+    parser.add_argument("--personas", default="persona.json")
+    parser.add_argument("--stage-info", default="stage_info.json")
+    parser.add_argument("--limit", type=int, default=None, help="最多評估的對話數")
+    parser.add_argument("--max-turns", type=int, default=None, help="每場對話最多評估的回合數")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時重播的對話數")
+    parser.add_argument("--replay-latency", action="store_true", help="replay: 的 LLM 依錄製的延遲等待")
+    parser.add_argument("--output", default=None, help="完整結果 JSON 檔")
+    args = parser.parse_args()
+
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            configs = json.load(f)
+    else:
+        configs = [{"name": args.llm, "llm": args.llm}]
+    names = [config["name"] for config in configs]
+    if len(set(names)) != len(names):
+        raise SystemExit("設定名稱不可重複")
+
+    report = asyncio.run(run(args, configs))
+    print(format_tables(report["pareto"]))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,31 +2,121 @@ import json
 import random
 import os
 import uuid
+import time
 import asyncio
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, WebSocket
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
 from pydantic import BaseModel
-import aiofiles
 import uvicorn
-from collections import deque
+from contextlib import asynccontextmanager
 
 # 匯入你原本的模組
 from character import Character
 from llm.llm import LLM
-from llm.openaigpt import OpenAIGPT
-from llm.claude import Claude
-from llm.gemini import Gemini
+from llm.factory import choose_llm, key_pool_stats
+from llm.key_pool import NoAvailableKeyError
+from llm.resilient import breaker_stats
+from llm.scheduler import LLMScheduler, ScheduledLLM, Priority
+from llm.deadline import Deadline, DeadlineExceeded
+from llm.image_cache import image_cache
+from llm.metrics import registry, request_id_var, turn_stats_var, span, turn_stats, ACTIVE_SESSIONS, STAGE_TRANSITIONS, HTTP_REQUEST_SECONDS
 from judge import Judge
+from session import Session, persona_catalog, stage_catalog, compact_idle
+from transcript import TranscriptWriter
+import cProfile
+import threading
+from diagnostics import LoopLagMonitor, BlockingDetector, SamplingProfiler, profile_text, rss_bytes
 
 # 讀取環境變數
 load_dotenv()
 
-app = FastAPI(title="Character Chat API")
+# 精簡 JSON 編碼：有安裝 orjson 時使用，否則退回不含空白的標準 json
+try:
+    import orjson
+
+    def dumps_compact(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def dumps_compact(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# 事件迴圈延遲監測，結果透過 /stats 提供給負載測試工具
+loop_lag_monitor = LoopLagMonitor()
+
+# 除錯模式（DEBUG_DIAGNOSTICS=1）：記錄阻塞事件迴圈的堆疊，並開放 X-Profile 標頭與 /debug 端點
+DEBUG_DIAGNOSTICS = os.getenv("DEBUG_DIAGNOSTICS") == "1"
+blocking_detector = BlockingDetector(threshold=float(os.getenv("BLOCKING_THRESHOLD_MS", "100")) / 1000)
+# cProfile 同一時間只能有一個在執行
+profile_lock = asyncio.Lock()
+
+# 每回合的對話紀錄由背景執行緒寫入 JSONL；TRANSCRIPT_PATH 設為空字串可停用
+TRANSCRIPT_PATH = os.getenv("TRANSCRIPT_PATH", "transcripts/transcript.jsonl")
+transcript_writer = TranscriptWriter(
+    TRANSCRIPT_PATH,
+    max_bytes=int(os.getenv("TRANSCRIPT_MAX_BYTES", str(100 * 1024 * 1024))),
+    rotate_interval=float(os.getenv("TRANSCRIPT_ROTATE_SECONDS", "3600")),
+) if TRANSCRIPT_PATH else None
+
+def log_transcript(kind: str, session_id: str, **fields):
+    if transcript_writer is not None:
+        transcript_writer.write({
+            "type": kind, "ts": time.time(), "session_id": session_id, "request_id": request_id_var.get(), **fields,
+        })
+
+# 閒置超過 SESSION_IDLE_SECONDS 秒的會話會壓縮角色細節與對話紀錄（0 表示停用）
+SESSION_IDLE_SECONDS = float(os.getenv("SESSION_IDLE_SECONDS", "300"))
+SESSION_SWEEP_INTERVAL = 60.0
+
+async def compact_idle_sessions():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        compact_idle(sessions, SESSION_IDLE_SECONDS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop_lag_monitor.start()
+    if DEBUG_DIAGNOSTICS:
+        blocking_detector.start()
+    sweeper = asyncio.ensure_future(compact_idle_sessions()) if SESSION_IDLE_SECONDS > 0 else None
+    yield
+    if sweeper is not None:
+        sweeper.cancel()
+    await loop_lag_monitor.stop()
+    await blocking_detector.stop()
+    if transcript_writer is not None:
+        transcript_writer.close()
+
+app = FastAPI(title="Character Chat API", lifespan=lifespan)
 
 # 用來儲存會話資料（僅供示範，非生產環境用）
 sessions = {}
 
+# /start 可選用的 LLM。預設只有真實的供應商；mock 與 replay 只供測試、負載測試與基準量測使用，
+# 需要時由環境變數明確開啟（replay 的 ReplayLLM 是所有會話共用且有狀態的，同時只適合一個會話使用）。
+# 「供應商:模型」同樣需要維運人員明確加入此清單（例如 claude:claude-3-5-haiku-20241022）
+ALLOWED_LLM_CHOICES = {
+    name.strip().lower()
+    for name in os.getenv("ALLOWED_LLM_CHOICES", "openai,claude,gemini").split(",")
+    if name.strip()
+}
+
+# 同一 llm_choice 與角色的 LLM（含供應商 client 與重試設定）由所有會話共用，不在每次 /start 重新建立；
+# llm_choice 只能是 ALLOWED_LLM_CHOICES 之一，因此快取的數量有上限
+shared_llms = {}
+
+def shared_llm(llm_choice: str, role: str) -> LLM:
+    key = (llm_choice, role)
+    llm = shared_llms.get(key)
+    if llm is None:
+        llm = shared_llms[key] = choose_llm(llm_choice, role=role)
+    return llm
+
+# 所有 LLM 非同步呼叫共用的排程器，讓線上學員的請求優先於背景與批次流量
+scheduler = LLMScheduler(max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "16")))
+
 origins = [
     "http://localhost:9000",
     # 如有需要，也可以加入其他來源
@@ -40,31 +130,80 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 輔助函式：非同步載入隨機角色資料
-async def load_random_character_async(json_file: str) -> dict:
-    async with aiofiles.open(json_file, mode='r', encoding='utf-8') as file:
-        content = await file.read()
-        customers = json.loads(content)
-    return random.choice(customers)
-
-# 輔助函式：非同步載入階段資訊並建立以階段為鍵的字典
-async def load_stage_info_async(json_path: str) -> dict:
-    async with aiofiles.open(json_path, mode="r", encoding="utf-8") as f:
-        content = await f.read()
-        data = json.loads(content)
-    stage_dict = {item["階段"]: item for item in data}
-    return stage_dict
-
-# 根據 llm_choice 建立 LLM 實例
-def choose_llm(llm_name: str) -> LLM:
-    if llm_name.lower() == "openai":
-        return OpenAIGPT(os.getenv("OPENAI_API_KEY"))
-    elif llm_name.lower() == "claude":
-        return Claude(os.getenv("ANTHROPIC_API_KEY"))
-    elif llm_name.lower() == "gemini":
-        return Gemini(os.getenv("GEMINI_API_KEY"))
-    else:
-        raise ValueError(f"未知的 LLM: {llm_name}")
+class RequestContextMiddleware:
+    """
+    為每個請求指定 request id（沿用用戶端的 X-Request-ID），讓同一請求觸發的 LLM 呼叫共用同一編號，
+    並記錄 HTTP 延遲。
+    以純 ASGI 實作：@app.middleware("http") 會包裝 receive，端點收不到 http.disconnect，
+    run_unless_disconnected 就無法在用戶端斷線時取消回合。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = Headers(scope=scope).get("x-request-id") or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+        started = time.monotonic()
+        status = 500
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message).append("X-Request-ID", request_id)
+            await send(message)
+
+        try:
+            with span(f"{scope['method']} {scope['path']}"):
+                await self.app(scope, receive, send_with_request_id)
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            HTTP_REQUEST_SECONDS.observe(time.monotonic() - started, method=scope["method"], path=path, status=status)
+            request_id_var.reset(token)
+
+app.add_middleware(RequestContextMiddleware)
+
+class ProfileMiddleware:
+    """
+    除錯模式下帶有 X-Profile: 1 標頭的請求會以 cProfile 執行，回應內容改為 profile 報表，
+    原本的狀態碼放在 X-Profiled-Status 標頭。profile 期間同一事件迴圈上的其他請求也會被計入。
+    與 RequestContextMiddleware 相同，以純 ASGI 實作，不攔截 receive。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        headers = Headers(scope=scope) if scope["type"] == "http" else None
+        if headers is None or not DEBUG_DIAGNOSTICS or headers.get("x-profile") != "1":
+            await self.app(scope, receive, send)
+            return
+        if profile_lock.locked():
+            await PlainTextResponse("已有 profile 正在執行", status_code=409)(scope, receive, send)
+            return
+        status = 500
+
+        async def discard(message):
+            # 原本的回應內容不送出，只保留狀態碼
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        async with profile_lock:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, discard)
+            finally:
+                profiler.disable()
+        report = profile_text(profiler, sort=headers.get("x-profile-sort", "cumulative"))
+        await PlainTextResponse(report, headers={"X-Profiled-Status": str(status)})(scope, receive, send)
+
+app.add_middleware(ProfileMiddleware)
+
 
 # Pydantic 模型定義
 class StartSessionRequest(BaseModel):
@@ -88,47 +227,77 @@ class ChatResponse(BaseModel):
     stage_description: str
     is_pass: bool
     finished: bool
+    verdict_timed_out: bool = False  # 裁判在期限內未完成評估，本回合視為未通過
 
 class EndSessionRequest(BaseModel):
     session_id: str
 
+class BatchChatRequest(BaseModel):
+    items: list[ChatRequest]
+    stream: bool = False  # 以 NDJSON 逐筆回傳先完成的結果
+    delta: bool = False   # 每筆結果使用 turn_delta 的精簡格式
+
 # 建立 /start 端點，用於初始化會話
 @app.post("/start", response_model=StartSessionResponse)
-async def start_session(request: StartSessionRequest):
+async def start_session(request: StartSessionRequest, delta: bool = False):
+    """
+    delta=true 時回傳精簡格式，以 persona_id 取代完整的 character_info（用戶端以 GET /personas/{persona_id} 查詢並快取）。
+    """
     try:
-        # 非同步載入角色資料與階段資訊
-        character_data = await load_random_character_async('persona.json')
-        # 將角色資料格式化成字串（依原程式）
-        character_info_str = json.dumps(character_data, indent=2, ensure_ascii=False)
-        stage_info = await load_stage_info_async("stage_info.json")
+        # 角色資料與階段資訊由所有會話共用，只在檔案變動時重新載入
+        character_data, character_info_str = random.choice(await persona_catalog.async_get())
+        stage_info = await stage_catalog.async_get()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"檔案載入錯誤: {str(e)}")
 
+    llm_choice = request.llm_choice.strip().lower()
+    if llm_choice not in ALLOWED_LLM_CHOICES:
+        raise HTTPException(status_code=400, detail=f"不支援的 LLM: {request.llm_choice}")
     try:
-        llm = choose_llm(request.llm_choice)
+        # 角色與裁判各自使用自己的備援設定
+        character_llm = shared_llm(llm_choice, "character")
+        judge_llm = shared_llm(llm_choice, "judge")
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
+    except OSError:
+        # 例如伺服器設定的 cassette 不存在；不把伺服器端的路徑回傳給用戶端
+        raise HTTPException(status_code=500, detail="LLM 初始化失敗")
     
-    # 建立 Character 與 Judge 物件（假設這些類別皆有非同步方法）
-    character = Character(character_info_str, llm, stage_info)
-    judge = Judge(llm)
-    
-    # 初始對話歷史使用 deque（保留最近 3 則訊息），初始階段為 1
-    conversation_history = deque(maxlen=3)
-    stage = 1
-    # 儲存會話資料到 sessions 字典
     session_id = str(uuid.uuid4())
-    sessions[session_id] = {
-        "character": character,
-        "judge": judge,
-        "conversation_history": conversation_history,
-        "stage": stage,
-        "stage_info": stage_info,
+    # 依用途設定排程優先等級：回應與心理活動最優先，其次是裁判，角色細節生成屬於背景工作
+    reply_llm = ScheduledLLM(character_llm, scheduler, Priority.INTERACTIVE_REPLY, session_id)
+    role_llms = {
+        "detail": ScheduledLLM(character_llm, scheduler, Priority.BACKGROUND_DETAIL, session_id),
+        "inner_activity": reply_llm,
+        "reply": reply_llm,
     }
+
+    # 建立 Character 與 Judge 物件（角色細節以非同步方式生成，避免阻塞事件迴圈）
+    try:
+        # 角色的問題前面附上最近 3 則訊息
+        character = await Character.async_create(character_info_str, reply_llm, stage_info, role_llms=role_llms,
+                                                 history_window=3)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"生成角色時發生錯誤: {str(e)}")
+    judge = Judge(ScheduledLLM(judge_llm, scheduler, Priority.INTERACTIVE_JUDGE, session_id))
+    
+    # 角色細節生成完畢後不再需要背景優先等級的 LLM
+    role_llms.pop("detail")
+    stage = character.stage
+    sessions[session_id] = Session(character, judge, persona_id=character_data.get("客戶編號"))
+    ACTIVE_SESSIONS.set(len(sessions))
+    log_transcript("session_start", session_id, persona_id=character_data.get("客戶編號"), llm_choice=request.llm_choice)
     
     # 取得初始階段描述
     stage_description = character.get_current_stage_description() if hasattr(character, "get_current_stage_description") else ""
     
+    if delta:
+        return Response(dumps_compact({
+            "session_id": session_id,
+            "persona_id": character_data.get("客戶編號"),
+            "stage": stage,
+            "stage_description": stage_description,
+        }), media_type="application/json")
     return StartSessionResponse(
         session_id=session_id,
         character_info=character_data,
@@ -136,73 +305,366 @@ async def start_session(request: StartSessionRequest):
         stage_description=stage_description
     )
 
-# 建立 /chat 端點，用於持續對話
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    session = sessions.get(request.session_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    character: Character = session["character"]
-    judge: Judge = session["judge"]
-    conversation_history: deque = session["conversation_history"]
-    stage: int = session["stage"]
-    stage_info = session["stage_info"]
-    
-    # 將使用者訊息加入對話歷史
-    conversation_history.append(f"使用者: {request.user_input}")
+@app.get("/personas/{persona_id}")
+async def get_persona(persona_id: str):
+    """
+    查詢角色資料，內容與 /start 回傳的 character_info 相同。
+    """
+    for customer, _ in await persona_catalog.async_get():
+        if str(customer.get("客戶編號")) == persona_id:
+            return customer
+    raise HTTPException(status_code=404, detail="Persona not found")
+
+# 每回合的時間預算（秒），可由請求標頭 X-Turn-Budget 調低；角色回應使用其中 CHARACTER_BUDGET_SHARE 的比例，其餘留給裁判
+TURN_BUDGET_SECONDS = float(os.getenv("TURN_BUDGET_SECONDS", "90"))
+CHARACTER_BUDGET_SHARE = 0.75
+# 檢查用戶端是否已斷線的間隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.5
+
+def turn_budget(http_request: Request) -> float:
+    budget = TURN_BUDGET_SECONDS
+    header = http_request.headers.get("x-turn-budget")
+    if header:
+        try:
+            budget = min(budget, float(header))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="X-Turn-Budget 必須是秒數")
+    return budget
+
+async def run_unless_disconnected(http_request: Request, coro):
+    """
+    執行 coro，期間定期檢查用戶端是否斷線；斷線時取消進行中的 LLM 呼叫。
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                task.cancel()
+                # 499: 用戶端已關閉連線（nginx 慣例），回應不會被讀取
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        task.cancel()
+
+async def run_turn(session: Session, user_input: str, budget: float = None, session_id: str = None) -> ChatResponse:
+    """
+    執行一個對話回合；同一會話同時收到多個回合時（例如 /chat/batch 或重複送出），依到達順序逐一處理。
+    budget 秒的期限從取得會話鎖後才開始計算，排在同一會話其他回合後面的時間不佔用預算。
+    """
+    async with session.lock:
+        deadline = Deadline(budget) if budget is not None else None
+        return await _run_turn(session, user_input, deadline, session_id)
+
+async def _run_turn(session: Session, user_input: str, deadline: Deadline = None, session_id: str = None) -> ChatResponse:
+    """
+    執行一個對話回合：生成角色回應後交給裁判評估，並將本回合寫入對話紀錄。
+    角色回應逾時回傳 504，沒有可用的 LLM 金鑰時回傳 503，兩者皆不會留下本回合的紀錄；
+    裁判逾時則照常回傳角色回應，但視為未通過（verdict_timed_out=True）。
+    """
+    started = time.monotonic()
+    session.touch()
+    character: Character = session.character
+    judge: Judge = session.judge
+    stage: int = character.stage
     
-    # 將對話歷史合併為單一字串，用於生成回應
-    conversation = "\n".join(conversation_history)
+    # 角色會在本回合的使用者訊息前附上最近的對話（見 Character 的 history_window）
+    user_message = f"使用者: {user_input}"
     
     # 產生角色回應（呼叫非同步方法）
+    character_deadline = deadline.split(CHARACTER_BUDGET_SHARE) if deadline else None
     try:
-        response_text, inner_activity = await character.async_generate_response(conversation)
+        response_text, inner_activity = await character.async_generate_response(user_message, character_deadline)
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="生成回應逾時")
+    except NoAvailableKeyError:
+        # 所有供應商都沒有可用的金鑰（冷卻中或認證失敗）
+        raise HTTPException(status_code=503, detail="目前沒有可用的 LLM 金鑰，請稍後再試")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成回應時發生錯誤: {str(e)}")
     
-    # 將角色回應加入對話歷史
-    conversation_history.append(f"角色: {response_text}")
+    # 角色回應成功後才會將本回合加入對話紀錄
+    conversation = character.history.recent()
     
     # 取得目前階段描述（同步呼叫）
     stage_description = character.get_current_stage_description() if hasattr(character, "get_current_stage_description") else ""
     
     # 評估是否通過當前階段，傳入對話歷史（以字串形式）
+    verdict_timed_out = False
     try:
-        is_pass = await judge.async_evaluate_stage("\n".join(conversation_history), inner_activity, stage_description)
+        is_pass = await judge.async_evaluate_stage(conversation, inner_activity, stage_description, deadline)
+    except DeadlineExceeded:
+        is_pass = False
+        verdict_timed_out = True
+    except NoAvailableKeyError:
+        raise HTTPException(status_code=503, detail="目前沒有可用的 LLM 金鑰，請稍後再試")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"階段評估時發生錯誤: {str(e)}")
     
+    # 本回合的完整紀錄交給背景執行緒寫入；各階段耗時與 token 用量來自 turn_stats()
+    session.turns += 1
+    stats = turn_stats_var.get() or {}
+    log_transcript(
+        "turn", session_id,
+        persona_id=session.persona_id,
+        turn=session.turns,
+        stage=stage,
+        question=user_input,
+        inner_activity=inner_activity,
+        reply=response_text,
+        is_pass=is_pass,
+        verdict_timed_out=verdict_timed_out,
+        timings_ms=dict(stats.get("timings_ms", {}), total=round((time.monotonic() - started) * 1000, 3)),
+        input_tokens=stats.get("input_tokens"),
+        output_tokens=stats.get("output_tokens"),
+    )
+
     # 如果通過則進入下一階段
     if is_pass:
+        STAGE_TRANSITIONS.inc(from_stage=stage, to_stage=stage + 1)
         stage += 1
-        character.stage = stage  # 假設 Character 物件有 stage 屬性
+        character.stage = stage
     
-    # 更新 session 中的對話歷史與階段
-    session["stage"] = stage
-    
-    finished = False
     # 若階段超過階段資訊數量則對話結束
-    if stage > len(stage_info):
-        finished = True
+    finished = session.finished
+    session.touch()
     
     return ChatResponse(
         response_text=response_text,
         inner_activity=inner_activity,
-        conversation="\n".join(conversation_history),
+        conversation=conversation,
         current_stage=stage,
         stage_description=stage_description,
         is_pass=is_pass,
-        finished=finished
+        finished=finished,
+        verdict_timed_out=verdict_timed_out,
     )
 
+def turn_delta(session: Session, result: ChatResponse) -> dict:
+    """
+    本回合新增的資料：不含整段對話，階段描述只在階段改變時附上。
+    欄位：reply、inner、stage、pass，以及必要時的 stage_description、done、timeout。
+    """
+    delta = {
+        "reply": result.response_text,
+        "inner": result.inner_activity,
+        "stage": result.current_stage,
+        "pass": result.is_pass,
+    }
+    if result.is_pass and not result.finished:
+        delta["stage_description"] = session.character.get_current_stage_description()
+    if result.finished:
+        delta["done"] = True
+    if result.verdict_timed_out:
+        delta["timeout"] = True
+    return delta
+
+# 建立 /chat 端點，用於持續對話
+@app.post("/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest, http_request: Request, delta: bool = False):
+    """
+    delta=true 時只回傳本回合新增的資料（見 turn_delta），不重送整段對話。
+    """
+    session = sessions.get(request.session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    budget = turn_budget(http_request)
+    with turn_stats():
+        result = await run_unless_disconnected(
+            http_request, run_turn(session, request.user_input, budget, request.session_id)
+        )
+    if delta:
+        return Response(dumps_compact(turn_delta(session, result)), media_type="application/json")
+    return result
+
+# /chat/batch 同時執行的回合數上限；LLM 呼叫本身仍受排程器的併發上限約束
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "64"))
+batch_semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+async def run_batch_item(index: int, item: ChatRequest, budget: float, delta: bool) -> dict:
+    """
+    執行批次中的一筆回合，成功回傳 result，失敗回傳 error（不會拋出例外）。
+    """
+    session = sessions.get(item.session_id)
+    if not session:
+        return {"index": index, "session_id": item.session_id, "error": {"status": 404, "detail": "Session not found"}}
+    # 先依序取得會話鎖再佔用併發名額，排隊中的同會話回合不會佔住名額；期限從實際開始執行時起算
+    async with session.lock, batch_semaphore:
+        try:
+            with turn_stats():
+                result = await _run_turn(session, item.user_input, Deadline(budget), item.session_id)
+        except HTTPException as e:
+            return {"index": index, "session_id": item.session_id, "error": {"status": e.status_code, "detail": e.detail}}
+    payload = turn_delta(session, result) if delta else result.model_dump()
+    return {"index": index, "session_id": item.session_id, "result": payload}
+
+@app.post("/chat/batch")
+async def chat_batch(request: BatchChatRequest, http_request: Request):
+    """
+    一次送出多個會話的回合並同時處理，回傳 {"results": [...]}（依 items 順序）。
+    同一會話的多個回合依序執行；每筆各自有 result 或 error。
+    stream=true 時改以 NDJSON 每完成一筆就送出一行（順序為完成順序，以 index 對應）。
+    """
+    budget = turn_budget(http_request)
+    if not request.stream:
+        results = await run_unless_disconnected(http_request, asyncio.gather(*(
+            run_batch_item(index, item, budget, request.delta) for index, item in enumerate(request.items)
+        )))
+        return Response(dumps_compact({"results": results}), media_type="application/json")
+
+    async def stream():
+        tasks = [
+            asyncio.ensure_future(run_batch_item(index, item, budget, request.delta))
+            for index, item in enumerate(request.items)
+        ]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield dumps_compact(await finished) + b"\n"
+        finally:
+            # 用戶端中途斷線時取消尚未完成的回合
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.websocket("/ws/{session_id}")
+async def chat_ws(websocket: WebSocket, session_id: str):
+    """
+    以單一 WebSocket 連線進行整場對話。
+    用戶端傳送 {"user_input": "...", "id": 任意值}，伺服器依序處理並回傳 turn_delta 的內容（附上相同的 id）；
+    失敗時回傳 {"id": ..., "error": {"status": 狀態碼, "detail": 說明}}，非文字訊息回傳 status 400。
+    連線中斷時會取消進行中的回合。
+    """
+    session = sessions.get(session_id)
+    if not session:
+        await websocket.close(code=4404, reason="Session not found")
+        return
+    await websocket.accept()
+    incoming = asyncio.Queue()
+    current = None
+    disconnected = False
+
+    async def send(payload: dict):
+        await websocket.send_text(dumps_compact(payload).decode("utf-8"))
+
+    async def reader():
+        # 不論因斷線或其他接收錯誤結束，都要取消進行中的回合並通知主迴圈，否則主迴圈會一直等待
+        nonlocal disconnected
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                await incoming.put(message)
+        finally:
+            disconnected = True
+            if current is not None:
+                current.cancel()
+            incoming.put_nowait(None)
+
+    reader_task = asyncio.ensure_future(reader())
+    try:
+        while True:
+            received = await incoming.get()
+            if received is None:
+                break
+            text = received.get("text")
+            if text is None:
+                await send({"error": {"status": 400, "detail": "只接受文字訊息"}})
+                continue
+            try:
+                message = json.loads(text)
+                user_input = message["user_input"]
+            except (ValueError, KeyError, TypeError):
+                await send({"error": {"status": 400, "detail": "需要 user_input"}})
+                continue
+            message_id = message.get("id")
+            token = request_id_var.set(uuid.uuid4().hex)
+            try:
+                with turn_stats():
+                    current = asyncio.ensure_future(
+                        run_turn(session, user_input, TURN_BUDGET_SECONDS, session_id)
+                    )
+                    result = await current
+                payload = {"id": message_id, **turn_delta(session, result)}
+            except asyncio.CancelledError:
+                if disconnected:
+                    break
+                raise
+            except HTTPException as e:
+                payload = {"id": message_id, "error": {"status": e.status_code, "detail": e.detail}}
+            finally:
+                current = None
+                request_id_var.reset(token)
+            await send(payload)
+    finally:
+        reader_task.cancel()
+
 @app.post("/end")
 async def end_session(request: EndSessionRequest):
     if request.session_id in sessions:
-        del sessions[request.session_id]
+        session = sessions.pop(request.session_id)
+        ACTIVE_SESSIONS.set(len(sessions))
+        log_transcript("session_end", request.session_id, persona_id=session.persona_id,
+                       turns=session.turns, final_stage=session.stage)
         return {"detail": "Session ended successfully."}
     else:
         raise HTTPException(status_code=404, detail="Session not found")
 
+@app.get("/stats")
+async def stats(reset_loop_lag: bool = False):
+    # 各供應商金鑰池的用量與健康狀態、斷路器狀態、各優先等級的排隊時間，以及行程層級的指標
+    process = {
+        "sessions": len(sessions),
+        "rss_bytes": rss_bytes(),
+        "loop_lag": loop_lag_monitor.stats(),
+    }
+    if reset_loop_lag:
+        loop_lag_monitor.reset()
+    if transcript_writer is not None:
+        process["transcript"] = transcript_writer.stats()
+    process["image_cache"] = image_cache.stats()
+    return {"keys": key_pool_stats(), "breakers": breaker_stats(), "scheduler": scheduler.stats(), "process": process}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Prometheus 文字格式的指標：各階段延遲、token、錯誤、重試、階段通過次數、會話數與進行中的 LLM 呼叫
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+def require_debug():
+    if not DEBUG_DIAGNOSTICS:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+@app.get("/debug/blocking")
+async def debug_blocking():
+    # 最近幾次事件迴圈阻塞的時間長度與當下堆疊
+    require_debug()
+    return {"threshold_ms": blocking_detector.threshold * 1000, "reports": blocking_detector.stats()}
+
+@app.post("/debug/profile", response_class=PlainTextResponse)
+async def debug_profile(seconds: float = 5.0, mode: str = "sample"):
+    """
+    對整個事件迴圈 profile seconds 秒：
+    mode=sample 以取樣方式輸出 collapsed stack，mode=cprofile 輸出 cProfile 報表。
+    """
+    require_debug()
+    if mode not in ("sample", "cprofile"):
+        raise HTTPException(status_code=400, detail="mode 必須是 sample 或 cprofile")
+    seconds = min(seconds, 60.0)
+    if mode == "sample":
+        sampler = SamplingProfiler(threading.get_ident())
+        return await asyncio.to_thread(sampler.run, seconds)
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="已有 profile 正在執行")
+    async with profile_lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    return profile_text(profiler)
+
 if __name__ == "__main__":
     uvicorn.run("server:app", reload=True, host="localhost", port=8000)
@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import asyncio
+import aiofiles
+from character import Character
+from judge import Judge
+
+
+class JsonCatalog:
+    """
+    只載入一次、所有會話共用的 JSON 資料（角色資料與階段資訊）。
+    檔案修改時間改變時才重新載入，因此每個會話不必各自保存一份。
+    """
+    def __init__(self, path: str, build):
+        self.path = path
+        self.build = build  # 將解析後的 JSON 轉成共用的資料結構
+        self._mtime = None
+        self._value = None
+
+    def _changed(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        return mtime if mtime != self._mtime else None
+
+    def get(self):
+        mtime = self._changed()
+        if mtime is not None:
+            with open(self.path, encoding="utf-8") as f:
+                self._value = self.build(json.load(f))
+            self._mtime = mtime
+        return self._value
+
+    async def async_get(self):
+        mtime = self._changed()
+        if mtime is not None:
+            async with aiofiles.open(self.path, mode="r", encoding="utf-8") as f:
+                self._value = self.build(json.loads(await f.read()))
+            self._mtime = mtime
+        return self._value
+
+
+def build_personas(customers: list) -> list:
+    # 每位角色的 prompt 字串只格式化一次，同一角色的會話共用同一個字串物件
+    return [(customer, json.dumps(customer, indent=2, ensure_ascii=False)) for customer in customers]
+
+
+def build_stages(data: list) -> dict:
+    return {item["階段"]: item for item in data}
+
+
+persona_catalog = JsonCatalog("persona.json", build_personas)
+stage_catalog = JsonCatalog("stage_info.json", build_stages)
+
+
+class Session:
+    """
+    一個進行中的會話。階段與對話紀錄只存在 Character 上，這裡不另外保存副本。
+    """
+    __slots__ = ("character", "judge", "persona_id", "turns", "lock", "last_active")
+
+    def __init__(self, character: Character, judge: Judge, persona_id=None):
+        self.character = character
+        self.judge = judge
+        self.persona_id = persona_id
+        self.turns = 0
+        self.lock = asyncio.Lock()  # 同一會話的回合必須依序執行
+        self.last_active = time.monotonic()
+
+    @property
+    def stage(self) -> int:
+        return self.character.stage
+
+    @property
+    def stage_info(self) -> dict:
+        return self.character.stage_info
+
+    @property
+    def finished(self) -> bool:
+        return self.character.stage > len(self.character.stage_info)
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def compact(self) -> bool:
+        """
+        閒置的會話壓縮角色細節與對話紀錄；下一個回合開始時自動解壓。
+        """
+        return self.character.freeze()
+
+
+def compact_idle(sessions: dict, idle_seconds: float) -> int:
+    """
+    壓縮閒置超過 idle_seconds 秒、且沒有進行中回合的會話，回傳本次壓縮的數量。
+    """
+    cutoff = time.monotonic() - idle_seconds
+    compacted = 0
+    for session in list(sessions.values()):
+        if session.last_active < cutoff and not session.lock.locked() and session.compact():
+            compacted += 1
+    return compacted
@@ -0,0 +1,316 @@
+import re
+import glob
+import json
+import time
+import asyncio
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from character import Character, load_stage_info
+from judge import Judge
+from llm.llm import LLM
+from llm.factory import choose_llm, create_batch_backend
+from llm.batch import BatchCollector, BatchLLM
+from llm.pricing import estimate_cost
+from llm.metrics import turn_stats
+from transcript import TranscriptWriter
+
+load_dotenv()
+
+
+def load_personas(json_file: str) -> list:
+    """
+    讀取全部角色資料。
+    """
+    with open(json_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class ScriptedSalesperson:
+    """
+    依腳本檔扮演業務員。腳本以「[階段 N]」分組，每行一句話，
+    同一階段的句子依序循環；沒有分組的句子適用於所有階段。
+    """
+    def __init__(self, lines_by_stage: dict):
+        self.lines_by_stage = lines_by_stage
+
+    @classmethod
+    def from_file(cls, path: str) -> "ScriptedSalesperson":
+        lines_by_stage = defaultdict(list)
+        stage = 0
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                header = re.fullmatch(r"\[階段\s*(\d+)\]", line)
+                if header:
+                    stage = int(header.group(1))
+                    continue
+                lines_by_stage[stage].append(line)
+        return cls(dict(lines_by_stage))
+
+    async def next_line(self, stage: int, stage_description: str, history: list, turn: int) -> str:
+        lines = self.lines_by_stage.get(stage) or self.lines_by_stage.get(0)
+        if not lines:
+            lines = [line for group in self.lines_by_stage.values() for line in group]
+        turns_in_stage = sum(1 for item in history if item["stage"] == stage)
+        return lines[turns_in_stage % len(lines)]
+
+
+class LLMSalesperson:
+    """
+    由另一個 LLM 扮演業務員，依目前階段目標與對話紀錄說出下一句話。
+    """
+    def __init__(self, llm: LLM):
+        self.llm = llm
+
+    async def next_line(self, stage: int, stage_description: str, history: list, turn: int) -> str:
+        history_text = "\n".join(
+            f"業務員：{item['question']}\n客戶：{item['response']}" for item in history[-6:]
+        )
+        prompt = f"""你是一位專業的保險業務員，正在與一位潛在客戶對話。
+        目前的銷售階段資訊：
+        {stage_description}
+        過去的對話紀錄：
+        {history_text}
+        請依照目前階段的目標，說出你的下一句話。請只輸出業務員要說的話，不要有其他內容。
+        """
+        return (await self.llm.async_generate(prompt)).strip()
+
+
+def build_salesperson(spec: str, collector: BatchCollector = None):
+    """
+    spec 為 script:<腳本檔> 或 llm:<openai|claude|gemini|mock>；批次模式下 LLM 業務員也改走批次 API。
+    """
+    kind, _, value = spec.partition(":")
+    if kind == "script":
+        return ScriptedSalesperson.from_file(value)
+    if kind == "llm":
+        if collector is not None:
+            return LLMSalesperson(BatchLLM(collector))
+        return LLMSalesperson(choose_llm(value, role="salesperson"))
+    raise ValueError(f"未知的業務員設定: {spec}")
+
+
+def usage_cost(llm: LLM) -> float:
+    cost = estimate_cost(llm.default_model, llm.usage["input_tokens"], llm.usage["output_tokens"])
+    return cost * getattr(llm, "price_multiplier", 1.0)
+
+
+async def run_conversation(conversation_id: int, persona: dict, args, stage_info: dict,
+                           collector: BatchCollector = None, writer: TranscriptWriter = None) -> dict:
+    """
+    執行一場業務員對客戶的完整對話，流程與 server.py 的 /chat 相同，
+    直到通過所有階段或達到 max_turns 為止。
+    傳入 collector 時所有 LLM 呼叫都改走批次 API，對話會在批次結果回來後才繼續；
+    傳入 writer 時每回合以與 server.py 相同的格式寫入對話紀錄。
+    """
+    started = time.monotonic()
+    if collector is not None:
+        customer_llm = BatchLLM(collector)
+        judge_llm = BatchLLM(collector)
+    else:
+        customer_llm = choose_llm(args.customer_llm, role="character")
+        judge_llm = choose_llm(args.judge_llm or args.customer_llm, role="judge")
+    salesperson = build_salesperson(args.salesperson, collector)
+    character_info_str = json.dumps(persona, indent=2, ensure_ascii=False)
+    character = await Character.async_create(character_info_str, customer_llm, stage_info, history_window=3)
+    judge = Judge(judge_llm)
+    history = []
+    turns_per_stage = defaultdict(int)
+    stage = 1
+
+    for turn in range(args.max_turns):
+        stage_description = character.get_current_stage_description()
+        user_input = await salesperson.next_line(stage, stage_description, history, turn)
+        turn_started = time.monotonic()
+        with turn_stats() as stats:
+            response_text, inner_activity = await character.async_generate_response(f"使用者: {user_input}")
+            is_pass = await judge.async_evaluate_stage(character.history.recent(), inner_activity, stage_description)
+        history.append({"stage": stage, "question": user_input, "response": response_text, "is_pass": is_pass})
+        if writer is not None:
+            writer.write({
+                "type": "turn", "ts": time.time(), "session_id": f"sim-{conversation_id}",
+                "persona_id": persona.get("客戶編號"), "turn": turn + 1, "stage": stage,
+                "question": user_input, "inner_activity": inner_activity, "reply": response_text,
+                "is_pass": is_pass, "verdict_timed_out": False,
+                "timings_ms": dict(stats["timings_ms"], total=round((time.monotonic() - turn_started) * 1000, 3)),
+                "input_tokens": stats["input_tokens"], "output_tokens": stats["output_tokens"],
+            })
+        turns_per_stage[stage] += 1
+        if is_pass:
+            stage += 1
+            character.stage = stage
+        if stage > len(stage_info):
+            break
+
+    llms = [customer_llm, judge_llm]
+    if isinstance(salesperson, LLMSalesperson):
+        llms.append(salesperson.llm)
+    return {
+        "conversation_id": conversation_id,
+        "persona_id": persona.get("客戶編號"),
+        "finished": stage > len(stage_info),
+        "final_stage": stage,
+        "turns": len(history),
+        "turns_per_stage": dict(turns_per_stage),
+        "elapsed": round(time.monotonic() - started, 3),
+        "input_tokens": sum(llm.usage["input_tokens"] for llm in llms),
+        "output_tokens": sum(llm.usage["output_tokens"] for llm in llms),
+        "cost": round(sum(usage_cost(llm) for llm in llms), 6),
+    }
+
+
+def load_checkpoint(path: str) -> dict:
+    """
+    讀取檢查點（含多行程模式下各分片的檔案），回傳 {conversation_id: 結果}。
+    """
+    results = {}
+    for part in glob.glob(glob.escape(path)) + glob.glob(glob.escape(path) + ".part*"):
+        with open(part, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        result = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 當機時寫到一半的最後一行
+                    results[result["conversation_id"]] = result
+    return results
+
+
+async def run_shard(args, conversation_ids: list, checkpoint_path: str, transcript_path: str = None) -> int:
+    """
+    在單一事件迴圈中以最多 args.concurrency 個 task 同時執行多場對話，
+    每完成一場就寫入檢查點。
+    """
+    personas = load_personas(args.personas)
+    stage_info = load_stage_info(args.stage_info)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    completed = 0
+    collector = None
+    if args.batch:
+        collector = BatchCollector(
+            create_batch_backend(args.batch),
+            max_batch_size=args.batch_size,
+            flush_interval=args.batch_flush_interval,
+            poll_interval=args.batch_poll_interval,
+        )
+    # 模擬的寫入速度遠高於線上流量，加大佇列以免紀錄被丟棄
+    writer = TranscriptWriter(transcript_path, max_queue=100000) if transcript_path else None
+
+    async def worker(conversation_id):
+        nonlocal completed
+        async with semaphore:
+            persona = personas[conversation_id % len(personas)]
+            try:
+                result = await run_conversation(conversation_id, persona, args, stage_info, collector, writer)
+            except Exception as e:
+                print(f"對話 {conversation_id} 失敗: {e}")
+                return
+        with open(checkpoint_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        completed += 1
+
+    await asyncio.gather(*(worker(conversation_id) for conversation_id in conversation_ids))
+    if writer is not None:
+        await asyncio.to_thread(writer.close)
+    return completed
+
+
+def _run_shard_process(args, conversation_ids, checkpoint_path, transcript_path):
+    return asyncio.run(run_shard(args, conversation_ids, checkpoint_path, transcript_path))
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(results: list, elapsed: float, completed_this_run: int) -> dict:
+    """
+    彙整模擬結果：每分鐘完成的對話數、各階段所需回合數與費用。
+    """
+    stage_turns = defaultdict(list)
+    for result in results:
+        for stage, turns in result["turns_per_stage"].items():
+            # 只統計有通過的階段，最後卡住的階段另計
+            if int(stage) < result["final_stage"]:
+                stage_turns[int(stage)].append(turns)
+    return {
+        "conversations": len(results),
+        "completed_this_run": completed_this_run,
+        "elapsed_seconds": round(elapsed, 2),
+        "conversations_per_minute": round(completed_this_run / elapsed * 60, 2) if elapsed else None,
+        "finish_rate": round(sum(result["finished"] for result in results) / len(results), 4) if results else None,
+        "turns_p50": percentile([result["turns"] for result in results], 0.5),
+        "turns_to_complete_stage": {
+            stage: {
+                "count": len(turns),
+                "mean": round(sum(turns) / len(turns), 2),
+                "p50": percentile(turns, 0.5),
+                "p90": percentile(turns, 0.9),
+            }
+            for stage, turns in sorted(stage_turns.items())
+        },
+        "input_tokens": sum(result["input_tokens"] for result in results),
+        "output_tokens": sum(result["output_tokens"] for result in results),
+        "cost": round(sum(result["cost"] for result in results), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="無介面的大量業務員對客戶對話模擬")
+    parser.add_argument("-n", "--conversations", type=int, default=100, help="對話場數")
+    parser.add_argument("--customer-llm", default="mock", help="扮演客戶的 LLM")
+    parser.add_argument("--judge-llm", default=None, help="裁判使用的 LLM（預設與客戶相同）")
+    parser.add_argument("--salesperson", default="script:sales_script.txt",
+                        help="業務員來源：script:<腳本檔> 或 llm:<openai|claude|gemini|mock>")
+    parser.add_argument("--personas", default="persona.json")
+    parser.add_argument("--stage-info", default="stage_info.json")
+    parser.add_argument("--max-turns", type=int, default=30, help="每場對話的回合上限")
+    parser.add_argument("--concurrency", type=int, default=16, help="每個行程同時進行的對話數")
+    parser.add_argument("--processes", type=int, default=1, help="行程數，大於 1 時使用行程池")
+    parser.add_argument("--checkpoint", default="simulation_checkpoint.jsonl", help="檢查點檔案，重新執行時會跳過已完成的對話")
+    parser.add_argument("--report", default=None, help="將彙整報告輸出為 JSON 檔")
+    parser.add_argument("--transcript", default=None, help="逐回合對話紀錄（JSONL），多行程時每個行程各寫一個 .part 檔")
+    parser.add_argument("--batch", default=None, choices=["claude", "http"],
+                        help="改用批次 API 執行（http 為本機替身批次伺服器，見 llm/batch_stub.py）")
+    parser.add_argument("--batch-size", type=int, default=1000, help="每個批次的請求上限")
+    parser.add_argument("--batch-flush-interval", type=float, default=5.0, help="湊批次的最長等待秒數")
+    parser.add_argument("--batch-poll-interval", type=float, default=10.0, help="查詢批次結果的間隔秒數")
+    args = parser.parse_args()
+
+    done = load_checkpoint(args.checkpoint)
+    pending = [i for i in range(args.conversations) if i not in done]
+    print(f"已完成 {len(done)} 場，剩餘 {len(pending)} 場")
+
+    started = time.monotonic()
+    if args.processes <= 1:
+        completed = asyncio.run(run_shard(args, pending, args.checkpoint, args.transcript))
+    else:
+        shards = [pending[i::args.processes] for i in range(args.processes)]
+        with ProcessPoolExecutor(max_workers=args.processes) as pool:
+            futures = [
+                pool.submit(_run_shard_process, args, shard, f"{args.checkpoint}.part{i}",
+                            f"{args.transcript}.part{i}" if args.transcript else None)
+                for i, shard in enumerate(shards) if shard
+            ]
+            completed = sum(future.result() for future in futures)
+    elapsed = time.monotonic() - started
+
+    results = [result for conversation_id, result in load_checkpoint(args.checkpoint).items()
+               if conversation_id < args.conversations]
+    report = summarize(results, elapsed, completed)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
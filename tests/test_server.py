@@ -0,0 +1,88 @@
+import os
+import json
+import asyncio
+
+# server.py 在匯入時讀取這些設定：不寫對話紀錄，並讓每次 MockLLM 呼叫花一點時間，斷線時回合才會在進行中
+os.environ["TRANSCRIPT_PATH"] = ""
+os.environ["ALLOWED_LLM_CHOICES"] = "mock"
+os.environ["MOCK_LLM_LATENCY"] = "fixed:0.3"
+
+import server
+from judge import Judge
+
+
+async def asgi_request(path: str, payload: dict, disconnect_after: float = None) -> dict:
+    """
+    直接以 ASGI 介面送出一個 POST 請求；disconnect_after 秒後模擬用戶端關閉連線（http.disconnect）。
+    回傳 {"status": 狀態碼, "body": 回應內容}。
+    """
+    body = json.dumps(payload).encode("utf-8")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode("ascii"),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 12345),
+        "server": ("testserver", 80),
+    }
+    loop = asyncio.get_running_loop()
+    disconnect_at = loop.time() + disconnect_after if disconnect_after is not None else None
+    sent_body = False
+    response = {"status": None, "body": b""}
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # 與 uvicorn 相同：已斷線時立即回傳，Request.is_disconnected 不等待就能得知
+        if disconnect_at is None:
+            await asyncio.Event().wait()
+        if loop.time() < disconnect_at:
+            await asyncio.sleep(disconnect_at - loop.time())
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    await server.app(scope, receive, send)
+    return response
+
+
+def test_client_disconnect_cancels_turn(monkeypatch):
+    monkeypatch.setattr(server, "DISCONNECT_POLL_INTERVAL", 0.05)
+    judged = []
+    evaluate_stage = Judge.async_evaluate_stage
+
+    async def counting_evaluate_stage(self, *args, **kwargs):
+        judged.append(args)
+        return await evaluate_stage(self, *args, **kwargs)
+
+    monkeypatch.setattr(Judge, "async_evaluate_stage", counting_evaluate_stage)
+
+    async def scenario():
+        started = await asgi_request("/start", {"llm_choice": "mock"})
+        assert started["status"] == 200
+        session_id = json.loads(started["body"])["session_id"]
+        session = server.sessions[session_id]
+
+        # 角色回應需要兩次 0.3 秒的呼叫，0.1 秒時斷線應在裁判開始前取消回合
+        response = await asgi_request("/chat", {"session_id": session_id, "user_input": "你好"}, disconnect_after=0.1)
+        assert response["status"] == 499
+        # 等到原本的回合早已完成的時間點，確認被取消的呼叫沒有在背景繼續執行
+        await asyncio.sleep(1.0)
+        assert judged == []
+        assert session.turns == 0
+        assert len(session.character.history) == 0
+        assert not session.lock.locked()
+
+    asyncio.run(scenario())
@@ -0,0 +1,206 @@
+import os
+import gzip
+import json
+import time
+import queue
+import shutil
+import logging
+import threading
+from llm.metrics import registry, Counter
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIPT_RECORDS = registry.register(Counter(
+    "transcript_records_total", "逐回合紀錄的處理結果（written、dropped、failed）", ("outcome",),
+))
+
+_STOP = object()
+
+
+class TranscriptWriter:
+    """
+    以背景執行緒將對話紀錄寫成 append-only 的 JSONL 檔。
+
+    - write() 只把紀錄放進有上限的佇列，不做任何 I/O，可以直接在請求路徑上呼叫；
+      佇列已滿（寫入跟不上）時丟棄該筆並計數，而不是阻塞事件迴圈。
+    - 背景執行緒一次取出最多 batch_size 筆，合併成一次寫入。
+    - 檔案超過 max_bytes 或開啟超過 rotate_interval 秒時輪替：
+      目前的檔案改名為「<名稱>-<時間>.jsonl」，compress=True 時再壓縮成 .gz。
+    - 無法序列化的紀錄與寫檔失敗的批次記為 failed 並寫入 log；寫檔失敗後關閉檔案，下一批重新開啟，
+      背景執行緒不會因此停止。
+    """
+    def __init__(self, path: str, max_queue: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 1.0, max_bytes: int = 100 * 1024 * 1024,
+                 rotate_interval: float = 3600.0, compress: bool = True):
+        self.path = path
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rotations = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = None
+        self._opened_at = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name="transcript-writer", daemon=True)
+            self._thread.start()
+
+    def write(self, record: dict) -> bool:
+        """
+        加入一筆紀錄；佇列已滿時丟棄並回傳 False。
+        """
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            TRANSCRIPT_RECORDS.inc(outcome="dropped")
+            return False
+
+    def close(self, timeout: float = None):
+        """
+        寫完佇列中剩餘的紀錄後關閉檔案。
+        """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "rotations": self.rotations,
+        }
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            while item is not None:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+            if batch:
+                self._write_batch(batch)
+            try:
+                if self._file is not None and self._should_rotate():
+                    self._rotate()
+            except OSError:
+                logger.exception("輪替對話紀錄檔失敗: %s", self.path)
+                self._close_file()
+        self._close_file()
+
+    def _fail(self, count: int):
+        self.failed += count
+        TRANSCRIPT_RECORDS.inc(count, outcome="failed")
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def _write_batch(self, batch: list):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+            except (TypeError, ValueError):
+                logger.exception("無法序列化的對話紀錄: %r", record.get("type"))
+                self._fail(1)
+        if not lines:
+            return
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+                self._opened_at = time.monotonic()
+            self._file.write("\n".join(lines) + "\n")
+            self._file.flush()
+        except OSError:
+            # 這一批視為遺失；關閉檔案，下一批重新開啟
+            logger.exception("寫入對話紀錄檔失敗: %s", self.path)
+            self._fail(len(lines))
+            self._close_file()
+            return
+        self.written += len(lines)
+        TRANSCRIPT_RECORDS.inc(len(lines), outcome="written")
+
+    def _should_rotate(self) -> bool:
+        return (self._file.tell() >= self.max_bytes
+                or time.monotonic() - self._opened_at >= self.rotate_interval)
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        base, ext = os.path.splitext(self.path)
+        rotated = f"{base}-{time.strftime('%Y%m%d-%H%M%S')}-{self.rotations:04d}{ext}"
+        os.replace(self.path, rotated)
+        if self.compress:
+            with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+        self.rotations += 1
+
+
+def transcript_files(path: str) -> list:
+    """
+    回傳 path 輪替後的檔案（含 .gz，依時間排序）以及目前的檔案。
+    """
+    base, ext = os.path.splitext(path)
+    directory = os.path.dirname(path) or "."
+    prefix = os.path.basename(base) + "-"
+    rotated = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith(prefix) and (name.endswith(ext) or name.endswith(ext + ".gz"))
+    ) if os.path.isdir(directory) else []
+    return rotated + ([path] if os.path.exists(path) else [])
+
+
+def open_transcript(file_path: str):
+    opener = gzip.open if file_path.endswith(".gz") else open
+    return opener(file_path, "rt", encoding="utf-8")
+
+
+def read_transcripts(path: str):
+    """
+    依序讀取輪替後的檔案（含 .gz）與目前的檔案，逐筆回傳紀錄。
+    """
+    for file_path in transcript_files(path):
+        with open_transcript(file_path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 當機時寫到一半的最後一行